@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Times loading and saving user data snapshots in each format for synthetic datasets.
+
+Usage: python bench_user_data.py [user_count ...]   (default: 10000 100000 1000000)
+
+Runs in a temporary directory, so it never touches a real user_data.json / user_data.bin.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+SYNTHETIC_ITEM_COUNT = 300 # Distinct item names in the synthetic inventories (about the size of the case catalog)
+
+
+def make_synthetic_users(bot, user_count: int, seed: int = 730):
+    """Builds {user_id: UserRecord} with a few inventory items each, drawn from a fixed set of synthetic items."""
+    rng = random.Random(seed)
+    # Interned here so the data does not depend on which case catalog (if any) the bot loaded
+    item_ids = [bot.intern_item(f"Bench Skin {n} (Field-Tested)") for n in range(SYNTHETIC_ITEM_COUNT)]
+    records = {}
+    for i in range(user_count):
+        user_id = 100_000_000_000_000_000 + i # Snowflake-sized IDs
+        inventory = {}
+        for _ in range(rng.randint(0, 12)):
+            item_id = rng.choice(item_ids)
+            inventory[item_id] = inventory.get(item_id, 0) + 1
+        records[user_id] = bot.UserRecord(round(rng.uniform(-500, 500), 2), rng.randint(0, 400), inventory)
+    return records
+
+
+def bench_format(bot, records, snapshot_format: str):
+    """Returns (save_seconds, load_seconds, file_bytes) for one snapshot format."""
+    bot.USER_DATA_SNAPSHOT_FORMAT = snapshot_format
+    path = bot._snapshot_path(snapshot_format)
+
+    start = time.perf_counter()
+    fragments = {uid: record.snapshot_fragment() for uid, record in records.items()}
+    bot._write_snapshot(fragments, bot.item_names[:], 0)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if snapshot_format == "binary":
+        loaded, _ = bot._read_binary_snapshot(path)
+    else:
+        loaded, _ = bot._read_json_snapshot(path)
+    load_seconds = time.perf_counter() - start
+
+    assert len(loaded) == len(records), "Round trip lost users"
+    return save_seconds, load_seconds, os.path.getsize(path)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Import from inside the temp dir: discordbot loads (and at exit saves) user data from the cwd.
+        # The case catalog is read from the cwd too, so bring a copy along.
+        catalog_file = os.path.join(SCRIPT_DIR, "cases.json")
+        if os.path.exists(catalog_file):
+            shutil.copy(catalog_file, work_dir)
+        os.chdir(work_dir)
+        sys.path.insert(0, SCRIPT_DIR)
+        import discordbot as bot
+
+        print(f"{'users':>10} {'format':>7} {'save (s)':>9} {'load (s)':>9} {'size (MB)':>10}")
+        for user_count in sizes:
+            records = make_synthetic_users(bot, user_count)
+            for snapshot_format in ("json", "binary"):
+                save_seconds, load_seconds, file_bytes = bench_format(bot, records, snapshot_format)
+                print(f"{user_count:>10} {snapshot_format:>7} {save_seconds:>9.3f} {load_seconds:>9.3f} {file_bytes / 1e6:>10.1f}")
+        os.chdir(SCRIPT_DIR)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,40 +4,19 @@ from bs4 import BeautifulSoup
 import urllib.parse
 import webbrowser
 import time
+import json
 
 # ======== CONFIG ========
 
-case_contents = {
-    "Mil-Spec (Blue)": [
-        "MAC-10 | Oceanic (Field-Tested)",
-        "CZ75-Auto | Tacticat (Field-Tested)",
-        "UMP-45 | Exposure (Field-Tested)"
-    ],
-    "Restricted (Purple)": [
-        "AK-47 | The Empress (Field-Tested)",
-        "Glock-18 | Off World (Field-Tested)"
-    ],
-    "Classified (Pink)": [
-        "P250 | See Ya Later (Field-Tested)"
-    ],
-    "Covert (Red)": [
-        "M4A1-S | Decimator (Field-Tested)"
-    ],
-    "Rare Special Item (Gold)": [
-        "★ Karambit | Lore (Field-Tested)"
-    ]
-}
-
-rarity_weights = {
-    "Mil-Spec (Blue)": 79.92,
-    "Restricted (Purple)": 15.98,
-    "Classified (Pink)": 3.2,
-    "Covert (Red)": 0.64,
-    "Rare Special Item (Gold)": 0.26
-}
+CASE_CATALOG_FILE = "cases.json"  # Same catalog file as discordbot.py
 
 # ======== FUNCTIONS ========
 
+def load_case_catalog():
+    with open(CASE_CATALOG_FILE, "r", encoding="utf-8") as f:
+        catalog = json.load(f)
+    return catalog["cases"], catalog["condition_chances"]
+
 def weighted_random_choice(weighted_dict):
     items = list(weighted_dict.keys())
     weights = list(weighted_dict.values())
@@ -90,9 +69,12 @@ def get_skin_image_url(skin_name):
         return None
 
 def open_case():
-    print("\n📦 Opening case... please hold your misplaced excitement.\n")
-    rarity = weighted_random_choice(rarity_weights)
-    skin = random.choice(case_contents[rarity])
+    cases, condition_chances = load_case_catalog()
+    case_name = random.choice(list(cases))
+    case_data = cases[case_name]
+    print(f"\n📦 Opening {case_name}... please hold your misplaced excitement.\n")
+    rarity = weighted_random_choice(case_data["weights"])
+    skin = random.choice(case_data["contents"][rarity]) + weighted_random_choice(condition_chances)
     print(f"You unboxed: {skin} [{rarity}]")
 
     print("\n💰 Fetching market price...")
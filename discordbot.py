@@ -5,14 +5,38 @@ from discord import app_commands
 from discord import ui # Import UI elements for buttons
 import asyncio
 import os
+import sys
 import random
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 import urllib.parse
 import io
 import json
 import re
+import struct
+from array import array
+import sqlite3
+import heapq
+import bisect
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import itertools
+import math
+import time
+from collections import Counter, OrderedDict
 from typing import Optional, List # For optional command arguments and type hinting
+from listing_extract import extract_listing_image_src, find_large_image_src
+try:
+    import numpy as np # Optional: only the !ev simulator needs it
+except ImportError:
+    np = None
+
+# Processes of the listing parse pool start fresh, and multiprocessing re-runs the main script in
+# them as "__mp_main__". They only need listing_extract, so the startup below (catalog, user data,
+# caches) is skipped there.
+IS_POOL_WORKER = __name__ == "__mp_main__"
 
 # Load Opus library if needed for other voice features (though core VC is removed)
 # Consider removing if absolutely no voice planned.
@@ -37,90 +61,1021 @@ intents.reactions = True           # Might be useful for interactions
 # Consider if you need guilds intent depending on server-specific features
 # intents.guilds = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+class CaseBot(commands.Bot):
+    """The bot, plus the aiohttp session every Steam request goes through."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steam_session: Optional[aiohttp.ClientSession] = None
+
+    async def setup_hook(self):
+        # Runs inside the event loop before login, so the session exists before any cog needs it
+        self.steam_session = create_steam_session()
+
+    async def close(self):
+        await super().close() # Unloads cogs first
+        if self.steam_session is not None:
+            await self.steam_session.close()
+            print("Steam HTTP session closed.")
+        shutdown_listing_parse_pool()
+        unit_value_store.flush()
+
+bot = CaseBot(command_prefix='!', intents=intents)
 
 # --- Configuration ---
 # !! WARNING: Enabling ban on knife is generally NOT recommended! !!
 ENABLE_BAN_ON_KNIFE = True # Set to True to enable banning users who unbox a knife
+MAX_MULTI_OPEN = 100 # Most cases one `!case <name> x N` / `/case count:N` may open
+# Case catalog (cases, their costs, contents and rarity weights, plus the wear chances)
+CASE_CATALOG_FILE = "cases.json"
+CASE_CATALOG_WATCH_INTERVAL = 10.0 # Seconds between checks for an edited catalog file (0 disables; !reloadcases still works)
+CASE_SUGGESTION_LIMIT = 5 # Suggestions shown when a case name is ambiguous
+CASE_FUZZY_CANDIDATES = 20 # Closest names (by shared trigrams) checked for typos
+# Expected value simulator (!ev / /ev)
+EV_MAX_OPENS = 1000 # Most opens one simulation may cover
+EV_SIMULATION_DRAWS = 4_000_000 # Simulated case openings per run (trials x opens)
+EV_MIN_TRIALS = 2000
+EV_MAX_TRIALS = 1_000_000
+EV_CHUNK_DRAWS = 1_000_000 # Draws generated at once, bounds memory use
+EV_RESULT_CACHE_SIZE = 64
+INVENTORY_PAGE_SIZE = 20 # Item types per !inventory page
+RECALC_TIMEOUT = 120 # Seconds before a recalculation reports a partial value
+RECALC_PROGRESS_INTERVAL = 2.0 # Seconds between progress edits of the recalculation message
+
+# Steam HTTP client (one pooled aiohttp session, owned by the bot)
+STEAM_COMMUNITY_URL = os.getenv("STEAM_COMMUNITY_URL", "https://steamcommunity.com").rstrip("/") # Point at a local fake server for testing
+STEAM_HTTP_TIMEOUT = 10 # Seconds for a whole request
+STEAM_HTTP_CONNECT_TIMEOUT = 5 # Seconds to establish a connection
+STEAM_MAX_CONNECTIONS_PER_HOST = 8 # Extra requests queue for a free connection
+STEAM_KEEPALIVE_TIMEOUT = 30 # Seconds an idle connection is kept for reuse
+# Steam rate limit, shared by every request the bot makes (token bucket)
+STEAM_RATE_LIMIT = 1 / 1.5 # Requests per second on average
+STEAM_RATE_BURST = 2 # Requests that may go back to back after an idle spell
+STEAM_RATE_LIMIT_BACKOFF = 10 # Seconds to pause all Steam traffic after a 429
+# Request priority classes; waiting requests are served lowest number first
+PRIORITY_INTERACTIVE = 0 # Someone is watching a !case / /case result
+PRIORITY_BULK = 1 # Inventory recalculation
+PRIORITY_BACKGROUND = 2 # Cache refreshes and other background work
+# Bulk pricing (market search returns many listings per request)
+MARKET_SEARCH_PAGE_SIZE = 100 # Listings per search request (Steam's maximum)
+MARKET_PRICE_CURRENCY_SYMBOL = "£" # Search prices in another currency are ignored, those items fall back to priceoverview
+MARKET_SEARCH_CURRENCY_COOLDOWN = 30 * 60 # Seconds to price with priceoverview only after a search answered in another currency
+# Skin images (built from the icon hash in market search JSON; listing HTML is only scraped as a fallback)
+MARKET_IMAGE_SEARCH_COUNT = 10 # Listings to look through for the exact skin (wears and StatTrak share a search)
+STEAM_ECONOMY_IMAGE_URL = "https://community.cloudflare.steamstatic.com/economy/image/"
+STEAM_ECONOMY_IMAGE_SIZE = "360fx360f" # Same size as the listing page's large image
+LISTING_STREAM_CHUNK_SIZE = 64 * 1024 # Bytes read at a time from a listing page; reading stops once the large image is found
+LISTING_PARSE_WORKERS = 2 # Processes for full-page scans (only when the streaming scan finds nothing)
+# Market price cache (shared by every command)
+PRICE_CACHE_TTL = 15 * 60 # Seconds a price counts as fresh; older ones are served while refreshing
+PRICE_CACHE_MAX_ENTRIES = 5000 # Least recently used prices beyond this are dropped
+# Skin image URL cache (persistent, image URLs practically never change)
+IMAGE_CACHE_DB_FILE = "market_cache.db"
+IMAGE_CACHE_NEGATIVE_TTL = 6 * 60 * 60 # Seconds to remember "no image found" before looking again
+# Last known unit values (kept in IMAGE_CACHE_DB_FILE too, so inventory values survive restarts)
+UNIT_VALUE_SAVE_DELAY = 5.0 # Seconds price changes are collected before one batched write
+# Catalog pre-warmer (fetches prices and images for every unboxable item in the background)
+PREWARM_ENABLED = True
+PREWARM_INTERVAL = PRICE_CACHE_TTL / 2 # Seconds between passes; each pass only refetches prices that are no longer fresh
 
 # --- User Data System (Inventory, Profit/Loss, Cases Opened) ---
 USER_DATA_FILE = "user_data.json"
-# Structure: { user_id: {"inventory": {item_name: count}, "profit_loss": float, "cases_opened": int} }
+USER_DATA_BINARY_FILE = "user_data.bin"
+# Snapshot format for the "json" and "journal" backends: "json" or "binary" (a columnar layout
+# that loads much faster). Whichever file exists is read; a snapshot in the other format is
+# converted on startup.
+USER_DATA_SNAPSHOT_FORMAT = "binary"
+# Persistence backend:
+#   "json"    - rewrite the whole USER_DATA_FILE on every save
+#   "journal" - append small delta records to USER_DATA_JOURNAL_FILE and periodically
+#               fold them into USER_DATA_FILE (the snapshot)
+#   "sqlite"  - store users and inventory rows in USER_DATA_DB_FILE (WAL mode); only the
+#               changed rows are written and leaderboards are read straight from the indexes.
+#               Users are loaded on demand and only the USER_CACHE_SIZE most recently active
+#               stay in memory. The file backends always hold every user.
+USER_DATA_BACKEND = "journal"
+USER_DATA_JOURNAL_FILE = "user_data.journal"
+JOURNAL_COMPACT_THRESHOLD = 500 # Compact the journal into the snapshot after this many records
+USER_DATA_DB_FILE = "user_data.db"
+USER_DATA_FLUSH_INTERVAL = 5.0 # Seconds. Changes are written at most once per interval, off the event loop
+USER_CACHE_SIZE = 5000 # sqlite backend: max users kept in memory (users with unwritten changes never count as evictable)
+LEADERBOARD_BUCKET_SIZE = 512 # File backends: users per bucket of the in-memory leaderboard indexes
+DISPLAY_NAME_TTL = 60 * 60 # Seconds a resolved leaderboard display name is reused
+# Snapshot layout (version 2):
+#   {"version": 2, "_journal_seq": int, "items": [item_name, ...],
+#    "users": {user_id: [profit_loss, cases_opened, {item_id: count}]}}
+# where item_id indexes "items". Version 1 files ({user_id: {"inventory": {item_name: count}, ...}})
+# are still read and get rewritten as version 2 on the next save.
+USER_DATA_SNAPSHOT_VERSION = 2
+# Binary snapshot layout (all little-endian):
+#   header (_BINARY_SNAPSHOT_HEADER): magic, format version, journal_seq, item count, user count,
+#     inventory entry count, byte length of the item name table
+#   item names, UTF-8, newline separated
+#   columns: user_id[q], profit_loss[d], cases_opened[q], inventory offsets[Q] (user count + 1),
+#     inventory item_id[I], inventory count[I]
+# User i owns inventory entries offsets[i]:offsets[i + 1].
+_BINARY_SNAPSHOT_MAGIC = b"CSUD"
+_BINARY_SNAPSHOT_VERSION = 1
+_BINARY_SNAPSHOT_HEADER = struct.Struct("<4sHqIIQQ")
+# Cached per-user row for the binary writer (native byte order): profit_loss, cases_opened, then
+# the inventory's item IDs and counts as uint32 runs of equal length
+_BINARY_ROW_HEAD = struct.Struct("=dq")
+
+# --- Item Catalog ---
+# Every distinct item name is interned once and referred to by a small integer ID everywhere
+# else (inventories, snapshots, the database). IDs are only ever appended, so an ID handed out
+# stays valid for the lifetime of the process.
+item_names: List[str] = []
+item_ids = {} # item_name -> item_id
+
+def intern_item(item_name: str) -> int:
+    """Returns the ID for an item name, assigning the next free one if it is new."""
+    item_id = item_ids.get(item_name)
+    if item_id is None:
+        item_name = sys.intern(item_name)
+        item_id = len(item_names)
+        item_names.append(item_name)
+        item_ids[item_name] = item_id
+    return item_id
+
+
+class UserRecord:
+    """A user's stats. `inventory` maps item IDs (see intern_item) to counts.
+
+    `inventory_value` is the inventory's market value at the last known prices. It is derived
+    (never saved) and kept up to date by _track_inventory and the price change hook.
+    """
+    __slots__ = ("inventory", "profit_loss", "cases_opened", "inventory_value")
+
+    def __init__(self, profit_loss: float = 0.0, cases_opened: int = 0, inventory: Optional[dict] = None):
+        self.profit_loss = profit_loss
+        self.cases_opened = cases_opened
+        self.inventory = inventory if inventory is not None else {}
+        self.inventory_value = 0.0
+
+    def inventory_by_name(self) -> dict:
+        """Returns the inventory keyed by full item name."""
+        return {item_names[item_id]: count for item_id, count in self.inventory.items()}
+
+    def snapshot_fragment(self):
+        """Serializes the record for the configured snapshot format.
+
+        JSON: the compact [profit_loss, cases_opened, {item_id: count}] text.
+        Binary: one packed bytes row (see _BINARY_ROW_HEAD), split into columns by the writer.
+        """
+        if USER_DATA_SNAPSHOT_FORMAT == "binary":
+            return (_BINARY_ROW_HEAD.pack(self.profit_loss, self.cases_opened)
+                    + array('I', self.inventory.keys()).tobytes() + array('I', self.inventory.values()).tobytes())
+        return json.dumps([self.profit_loss, self.cases_opened, self.inventory], separators=(',', ':'))
+
+
+# { user_id: UserRecord }
+# With the sqlite backend this is an LRU (OrderedDict, oldest first) of recently active users.
 user_data = {}
 
+# Dirty tracking: user_id -> set of inventory item IDs changed since the last flush.
+# _flushing_users holds the same for users handed to a write that has not succeeded yet;
+# if the write fails they go back into _dirty_users (and its journal lines back in the queue).
+_dirty_users = {}
+_flushing_users = {}
+_flushing_journal_lines = []
+_flushing_compaction_count = 0 # _journal_records_since_compaction before the unfinished write, restored if it fails
+# Serialized snapshot fragment per user for the file backends, re-encoded only when the user is
+# dirty, so a flush only copies references on the event loop and serializes in the worker
+_snapshot_fragments = {}
+# Serializes flushes between the background flusher thread and shutdown
+_flush_lock = threading.Lock()
+_flush_event = None
+_flusher_task = None
+
+# Journal state. Every record carries an increasing sequence number and the snapshot stores
+# the last one folded into it, so a crash between writing the snapshot and truncating the
+# journal never applies a delta twice.
+_journal_seq = 0
+_journal_records_since_compaction = 0
+_journal_handle = None
+_pending_journal_lines = []
+
+# Connections used by the sqlite backend (None for the file backends). Reads happen on the
+# event loop through _user_db, writes happen in the flusher thread through _user_db_writer;
+# WAL mode lets the two run at the same time.
+_user_db = None
+_user_db_writer = None
+# The database keeps its own items table; these map between its IDs and the in-process ones
+_db_item_id_for = {} # item_id -> database item_id
+_item_id_for_db = {} # database item_id -> item_id
+
+# --- Leaderboard Indexes ---
+class LeaderboardIndex:
+    """Active users ordered by one score, kept sorted as scores change (file backends).
+
+    Keys are (-score, user_id) in a list of sorted buckets, so an update is a bisect over the
+    bucket maxima plus an insert/delete in one short bucket rather than a full re-sort.
+    """
+    def __init__(self, score):
+        self._score = score # UserRecord -> number to rank by
+        self._buckets = [] # Sorted lists of keys, best first across buckets
+        self._maxes = [] # Last (worst) key of each bucket
+        self._keys = {} # user_id -> current key, only for users on the board
+
+    def update(self, user_id: int, record: Optional[UserRecord]):
+        """Moves a user to their current rank (or off the board if they are no longer active)."""
+        active = record is not None and (record.cases_opened > 0 or record.profit_loss != 0.0)
+        new_key = (-self._score(record), user_id) if active else None
+        old_key = self._keys.get(user_id)
+        if new_key == old_key:
+            return
+        if old_key is not None:
+            self._remove(old_key)
+            del self._keys[user_id]
+        if new_key is not None:
+            self._add(new_key)
+            self._keys[user_id] = new_key
+
+    def rebuild(self, records: dict):
+        """Replaces the index contents with every active user in `records`."""
+        self._keys = {uid: (-self._score(record), uid) for uid, record in records.items()
+                      if record.cases_opened > 0 or record.profit_loss != 0.0}
+        keys = sorted(self._keys.values())
+        self._buckets = [keys[i:i + LEADERBOARD_BUCKET_SIZE] for i in range(0, len(keys), LEADERBOARD_BUCKET_SIZE)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+
+    def top(self, count: int) -> List[int]:
+        """User IDs of the best `count` users, best first."""
+        return [uid for _, uid in itertools.islice(itertools.chain.from_iterable(self._buckets), count)]
+
+    def _add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[i]
+        bisect.insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        if len(bucket) > 2 * LEADERBOARD_BUCKET_SIZE: # Split so inserts stay cheap
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+
+leaderboard_by_profit = LeaderboardIndex(lambda record: record.profit_loss)
+leaderboard_by_cases = LeaderboardIndex(lambda record: record.cases_opened)
+
+def _update_leaderboards(user_id: int, record: UserRecord):
+    """Re-ranks a user after a change (the sqlite backend ranks with its own indexes instead)."""
+    if USER_DATA_BACKEND != "sqlite":
+        leaderboard_by_profit.update(user_id, record)
+        leaderboard_by_cases.update(user_id, record)
+
+
+# --- Inventory Values ---
+# Last known unit value per item ID, filled by the price cache hook (_on_price_change) and, at
+# startup, from unit_value_store. A price dropped from the price cache keeps its value here.
+item_unit_values = {}
+# Reverse index: item ID -> IDs of in-memory users holding it, so a price change only touches holders
+item_holders = {}
+
+class UnitValueStore:
+    """Persists item_unit_values (by item name) in a table next to the image URL cache.
+
+    Read once at startup; changes are collected for UNIT_VALUE_SAVE_DELAY seconds and written
+    in one batch from a worker thread, so a recalculation's worth of prices is one transaction.
+    """
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._pending = {} # item_name -> (unit_value, updated_at as a unix timestamp)
+        self._save_task = None
+
+    def open(self) -> dict:
+        """Opens (creating if needed) the table and returns {item_name: unit_value}."""
+        try:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS unit_values (
+                    item_name TEXT PRIMARY KEY,
+                    unit_value REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            return dict(self._db.execute("SELECT item_name, unit_value FROM unit_values"))
+        except sqlite3.Error as e:
+            print(f"Could not open unit value store {self.db_file}: {e}. Inventory values start at £0 after restarts.")
+            self._db = None
+            return {}
+
+    def remember(self, item_name: str, unit_value: float):
+        """Queues a unit value for the next batched write."""
+        self._pending[item_name] = (unit_value, time.time())
+        if self._db is None or (self._save_task is not None and not self._save_task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # Written by flush() at shutdown
+        self._save_task = loop.create_task(self._save_soon())
+
+    async def _save_soon(self):
+        await asyncio.sleep(UNIT_VALUE_SAVE_DELAY)
+        rows = self._take_pending()
+        await asyncio.to_thread(self._write, rows)
+
+    def flush(self):
+        """Writes anything still queued (used at shutdown)."""
+        if self._db is not None and self._pending:
+            self._write(self._take_pending())
+
+    def _take_pending(self) -> list:
+        rows = [(item_name, value, updated_at) for item_name, (value, updated_at) in self._pending.items()]
+        self._pending.clear()
+        return rows
+
+    def _write(self, rows: list):
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO unit_values (item_name, unit_value, updated_at) VALUES (?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                print(f"Error writing {len(rows)} unit values: {e}")
+
+unit_value_store = UnitValueStore(IMAGE_CACHE_DB_FILE)
+
+def load_unit_values():
+    """Restores the last known unit values, so inventory values are right straight after a restart."""
+    for item_name, unit_value in unit_value_store.open().items():
+        item_unit_values[intern_item(item_name)] = unit_value
+    print(f"Last known prices loaded for {len(item_unit_values)} items.")
+
+def inventory_value_coverage(user_record: UserRecord):
+    """Returns (item types with a known unit value, item types held)."""
+    return sum(1 for item_id in user_record.inventory if item_id in item_unit_values), len(user_record.inventory)
+
+def _track_inventory(user_id: int, user_record: UserRecord):
+    """Adds a freshly loaded user to the reverse index and computes their inventory value."""
+    value = 0.0
+    for item_id, count in user_record.inventory.items():
+        item_holders.setdefault(item_id, set()).add(user_id)
+        value += item_unit_values.get(item_id, 0.0) * count
+    user_record.inventory_value = value
+
+def _untrack_inventory(user_id: int, user_record: UserRecord):
+    """Removes a user from the reverse index (sqlite backend, on eviction)."""
+    for item_id in user_record.inventory:
+        holders = item_holders.get(item_id)
+        if holders is not None:
+            holders.discard(user_id)
+
+def _add_inventory_items(user_id: int, user_record: UserRecord, item_id: int, count: int):
+    """Adds items to an inventory and keeps the value and reverse index in step."""
+    user_record.inventory[item_id] = user_record.inventory.get(item_id, 0) + count
+    item_holders.setdefault(item_id, set()).add(user_id)
+    user_record.inventory_value += item_unit_values.get(item_id, 0.0) * count
+
+def _on_price_change(item_name: str, price_str: str):
+    """Price cache hook: re-values the item for every in-memory holder."""
+    item_id = item_ids.get(item_name)
+    if item_id is None:
+        return # Nobody has ever held it
+    new_value = parse_price(price_str)
+    old_value = item_unit_values.get(item_id)
+    if old_value != new_value:
+        unit_value_store.remember(item_names[item_id], new_value)
+    delta = new_value - (old_value or 0.0)
+    item_unit_values[item_id] = new_value
+    if delta:
+        for uid in item_holders.get(item_id, ()):
+            user_record = user_data[uid]
+            user_record.inventory_value += delta * user_record.inventory[item_id]
+
+
 def load_user_data():
-    """Loads user data from the JSON file."""
+    """Loads user data from the snapshot file (and replays the journal in journal mode).
+
+    The sqlite backend only opens the database here, rows are read on demand.
+    """
     global user_data
-    if os.path.exists(USER_DATA_FILE):
+    _dirty_users.clear()
+    _snapshot_fragments.clear()
+    if USER_DATA_BACKEND == "sqlite":
+        user_data = OrderedDict()
+        open_user_db()
+        return
+    converted_from = _load_user_data_files(replay_journal=USER_DATA_BACKEND == "journal")
+    for user_id, record in user_data.items():
+        _snapshot_fragments[user_id] = record.snapshot_fragment()
+    leaderboard_by_profit.rebuild(user_data)
+    leaderboard_by_cases.rebuild(user_data)
+    item_holders.clear()
+    for user_id, record in user_data.items():
+        _track_inventory(user_id, record)
+    if converted_from:
+        # Found a snapshot in the other format; write it in the configured one right away
+        print(f"Converting user data snapshot to {USER_DATA_SNAPSHOT_FORMAT} format...")
+        snapshot = _capture_snapshot()
+        if _run_user_data_flush(lambda: _write_snapshot(snapshot, item_names[:], _journal_seq)):
+            # Move the old file aside so switching formats back later can't load it (it would be stale)
+            os.replace(converted_from, converted_from + ".migrated")
+            print(f"Old snapshot kept as {converted_from}.migrated")
+
+def _snapshot_path(snapshot_format: str) -> str:
+    return USER_DATA_BINARY_FILE if snapshot_format == "binary" else USER_DATA_FILE
+
+def _load_user_data_files(replay_journal: bool) -> Optional[str]:
+    """Reads the snapshot into user_data, optionally replaying the journal on top.
+
+    Prefers the configured snapshot format and falls back to the other one. Returns the file's
+    path when the data came from the other format (i.e. the snapshot should be rewritten).
+    """
+    global user_data, _journal_seq
+    _journal_seq = 0
+    user_data = {}
+    other_format = "json" if USER_DATA_SNAPSHOT_FORMAT == "binary" else "binary"
+    converted = None
+    for snapshot_format in (USER_DATA_SNAPSHOT_FORMAT, other_format):
+        path = _snapshot_path(snapshot_format)
+        if not os.path.exists(path):
+            continue
         try:
-            with open(USER_DATA_FILE, 'r', encoding='utf-8') as f: # Specify encoding
-                loaded_data = json.load(f)
-                user_data = {}
-                for k, v in loaded_data.items():
-                    try:
-                        user_id = int(k)
-                        inventory = v.get("inventory", {})
-                        profit_loss = float(v.get("profit_loss", 0.0))
-                        cases_opened = int(v.get("cases_opened", 0)) # Load cases opened
-                        user_data[user_id] = {
-                            "inventory": inventory,
-                            "profit_loss": profit_loss,
-                            "cases_opened": cases_opened
-                        }
-                    except (ValueError, TypeError) as e:
-                        print(f"Skipping invalid data entry for key {k}: {e}")
-                print("User data loaded.")
-        except (json.JSONDecodeError, ValueError) as e:
+            if snapshot_format == "binary":
+                user_data, _journal_seq = _read_binary_snapshot(path)
+            else:
+                user_data, _journal_seq = _read_json_snapshot(path)
+            converted = path if snapshot_format != USER_DATA_SNAPSHOT_FORMAT else None
+            print("User data loaded.")
+        except (json.JSONDecodeError, ValueError, KeyError, TypeError, struct.error) as e:
             print(f"Error loading user data file: {e}. Starting with empty data.")
             user_data = {}
         except Exception as e:
              print(f"An unexpected error occurred loading user data: {e}")
              user_data = {}
+        break
     else:
         print("User data file not found. Starting with empty data.")
-        user_data = {}
 
-def save_user_data():
-    """Saves the current user data to the JSON file."""
-    global user_data
+    if replay_journal:
+        replay_user_data_journal()
+    return converted
+
+def _read_json_snapshot(path: str):
+    """Parses a JSON snapshot (version 1 or 2). Returns ({user_id: UserRecord}, journal_seq)."""
+    with open(path, 'r', encoding='utf-8') as f: # Specify encoding
+        loaded_data = json.load(f)
+    records = {}
+    journal_seq = int(loaded_data.get("_journal_seq", 0))
+    if loaded_data.get("version") == USER_DATA_SNAPSHOT_VERSION:
+        # Translate the file's item IDs to ours
+        local_ids = [intern_item(item_name) for item_name in loaded_data["items"]]
+        for k, (profit_loss, cases_opened, inventory) in loaded_data["users"].items():
+            try:
+                records[int(k)] = UserRecord(
+                    float(profit_loss), int(cases_opened),
+                    {local_ids[int(item_id)]: int(count) for item_id, count in inventory.items()}
+                )
+            except (ValueError, TypeError, IndexError) as e:
+                print(f"Skipping invalid data entry for key {k}: {e}")
+    else:
+        # Version 1: {user_id: {"inventory": {item_name: count}, "profit_loss": ..., "cases_opened": ...}}
+        for k, v in loaded_data.items():
+            if k.startswith("_"):
+                continue
+            try:
+                user_id = int(k)
+                inventory = {intern_item(item_name): int(count) for item_name, count in v.get("inventory", {}).items()}
+                profit_loss = float(v.get("profit_loss", 0.0))
+                cases_opened = int(v.get("cases_opened", 0)) # Load cases opened
+                records[user_id] = UserRecord(profit_loss, cases_opened, inventory)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Skipping invalid data entry for key {k}: {e}")
+    return records, journal_seq
+
+def _read_binary_snapshot(path: str):
+    """Parses a binary snapshot. Returns ({user_id: UserRecord}, journal_seq)."""
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    magic, version, journal_seq, item_count, user_count, entry_count, names_length = _BINARY_SNAPSHOT_HEADER.unpack_from(data)
+    if magic != _BINARY_SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a binary user data snapshot")
+    if version != _BINARY_SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported binary snapshot version {version}")
+    position = _BINARY_SNAPSHOT_HEADER.size
+    names = bytes(data[position:position + names_length]).decode('utf-8').split("\n") if item_count else []
+    position += names_length
+
+    def read_column(typecode: str, length: int) -> array:
+        nonlocal position
+        column = array(typecode)
+        end = position + length * column.itemsize
+        if end > len(data):
+            raise ValueError(f"{path} is truncated")
+        column.frombytes(data[position:end])
+        if sys.byteorder == "big":
+            column.byteswap()
+        position = end
+        return column
+
+    user_ids = read_column('q', user_count)
+    profit_losses = read_column('d', user_count)
+    cases_opened = read_column('q', user_count)
+    offsets = read_column('Q', user_count + 1)
+    inventory_ids = read_column('I', entry_count)
+    inventory_counts = read_column('I', entry_count)
+
+    local_ids = [intern_item(item_name) for item_name in names]
+    # Translate every item ID in one pass, then slice each user's run out of the flat columns
+    inventory_ids = list(map(local_ids.__getitem__, inventory_ids))
+    records = {}
+    for user_id, profit_loss, opened, start, end in zip(user_ids, profit_losses, cases_opened, offsets, offsets[1:]):
+        records[user_id] = UserRecord(profit_loss, opened, dict(zip(inventory_ids[start:end], inventory_counts[start:end])))
+    return records, journal_seq
+
+def replay_user_data_journal():
+    """Applies journal records newer than the snapshot to the in-memory user data."""
+    global _journal_seq, _journal_records_since_compaction
+    _journal_records_since_compaction = 0
+    if not os.path.exists(USER_DATA_JOURNAL_FILE):
+        return
+    replayed = 0
     try:
-        # Create a copy to avoid issues during iteration if data changes
-        data_to_save = {str(k): v for k, v in user_data.items()}
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f: # Specify encoding
-            json.dump(data_to_save, f, indent=4)
-    except Exception as e:
-        print(f"Error saving user data file: {e}")
+        with open(USER_DATA_JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    seq = int(record["seq"])
+                    _journal_records_since_compaction += 1
+                    if seq <= _journal_seq:
+                        continue # Already folded into the snapshot, or written twice by a retried flush
+                    user_id = int(record["uid"])
+                    user_record = user_data.get(user_id)
+                    if user_record is None:
+                        user_record = user_data[user_id] = UserRecord()
+                    op = record["op"]
+                    if op == "score":
+                        user_record.profit_loss += float(record["amount"])
+                    elif op == "item":
+                        # Journal records carry the item name so they do not depend on ID assignment
+                        item_id = intern_item(record["item"])
+                        user_record.inventory[item_id] = user_record.inventory.get(item_id, 0) + 1
+                    elif op == "opened":
+                        user_record.cases_opened += 1
+                    elif op == "batch":
+                        user_record.cases_opened += int(record["opened"])
+                        user_record.profit_loss += float(record["amount"])
+                        for item_name, count in record["items"].items():
+                            item_id = intern_item(item_name)
+                            user_record.inventory[item_id] = user_record.inventory.get(item_id, 0) + int(count)
+                    else:
+                        print(f"Skipping unknown journal op '{op}' on line {line_no}")
+                        continue
+                    _journal_seq = max(_journal_seq, seq)
+                    replayed += 1
+                except (json.JSONDecodeError, KeyError, ValueError, TypeError) as e:
+                    # A torn final line after a crash is expected; anything else is logged and skipped
+                    print(f"Skipping invalid journal record on line {line_no}: {e}")
+    except OSError as e:
+        print(f"Error reading user data journal: {e}")
+        return
+    if replayed:
+        print(f"Replayed {replayed} journal records.")
+
+def open_user_db():
+    """Opens (and creates/migrates if needed) the sqlite user database."""
+    global _user_db, _user_db_writer
+    if _user_db is not None:
+        return _user_db
+    # The writer is only ever used by one flush at a time (under _flush_lock), from whichever thread runs it
+    _user_db_writer = sqlite3.connect(USER_DATA_DB_FILE, check_same_thread=False)
+    _user_db_writer.execute("PRAGMA journal_mode=WAL")
+    _user_db_writer.execute("PRAGMA synchronous=NORMAL") # Durable at checkpoints, safe against corruption
+    inventory_columns = [row[1] for row in _user_db_writer.execute("PRAGMA table_info(inventory)")]
+    if "item_name" in inventory_columns:
+        _migrate_user_db_inventory_to_item_ids()
+    _user_db_writer.executescript("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            profit_loss REAL NOT NULL DEFAULT 0,
+            cases_opened INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            item_id INTEGER PRIMARY KEY,
+            item_name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS inventory (
+            user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, item_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_users_profit_loss ON users(profit_loss);
+        CREATE INDEX IF NOT EXISTS idx_users_cases_opened ON users(cases_opened);
+    """)
+    _db_item_id_for.clear()
+    _item_id_for_db.clear()
+    for db_item_id, item_name in _user_db_writer.execute("SELECT item_id, item_name FROM items"):
+        item_id = intern_item(item_name)
+        _db_item_id_for[item_id] = db_item_id
+        _item_id_for_db[db_item_id] = item_id
+    _user_db = sqlite3.connect(USER_DATA_DB_FILE)
+    has_users = _user_db.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+    if not has_users and (os.path.exists(USER_DATA_FILE) or os.path.exists(USER_DATA_BINARY_FILE)):
+        _migrate_snapshot_to_user_db()
+    print("User database opened.")
+    return _user_db
+
+def _migrate_user_db_inventory_to_item_ids():
+    """Converts an inventory table keyed by item name to the items + inventory(item_id) layout."""
+    print("Migrating user database inventory to item IDs...")
+    with _user_db_writer:
+        _user_db_writer.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                item_id INTEGER PRIMARY KEY,
+                item_name TEXT NOT NULL UNIQUE
+            );
+            INSERT OR IGNORE INTO items (item_name) SELECT DISTINCT item_name FROM inventory;
+            CREATE TABLE inventory_by_id (
+                user_id INTEGER NOT NULL,
+                item_id INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, item_id)
+            ) WITHOUT ROWID;
+            INSERT INTO inventory_by_id (user_id, item_id, count)
+                SELECT inventory.user_id, items.item_id, inventory.count
+                FROM inventory JOIN items ON items.item_name = inventory.item_name;
+            DROP TABLE inventory;
+            ALTER TABLE inventory_by_id RENAME TO inventory;
+        """)
+
+def _migrate_snapshot_to_user_db():
+    """One-off import of an existing snapshot (+ journal) into the empty database."""
+    global user_data
+    print(f"Migrating user data snapshot into {USER_DATA_DB_FILE}...")
+    # Reuse the file loader, then copy everything over in one transaction
+    _load_user_data_files(replay_journal=True)
+    rows = [(uid, record.profit_loss, record.cases_opened, dict(record.inventory)) for uid, record in user_data.items()]
+    _write_user_db_rows(rows, _assign_db_item_ids({item_id for row in rows for item_id in row[3]}))
+    print(f"Migrated {len(user_data)} users.")
+    user_data = OrderedDict()
+
+def _assign_db_item_ids(item_ids_used) -> List[tuple]:
+    """Maps item IDs to database item IDs, allocating new ones; returns the items rows to (re)insert."""
+    next_db_item_id = max(_item_id_for_db, default=0) + 1
+    new_rows = []
+    for item_id in item_ids_used:
+        if item_id not in _db_item_id_for:
+            _db_item_id_for[item_id] = next_db_item_id
+            _item_id_for_db[next_db_item_id] = item_id
+            next_db_item_id += 1
+        new_rows.append((_db_item_id_for[item_id], item_names[item_id]))
+    return new_rows
+
+def _write_user_db_rows(rows, item_rows):
+    """Upserts (user_id, profit_loss, cases_opened, {item_id: count}) rows in one transaction."""
+    with _user_db_writer:
+        # Item rows are cheap to repeat and keep the mapping valid even if an earlier write failed
+        _user_db_writer.executemany("INSERT OR IGNORE INTO items (item_id, item_name) VALUES (?, ?)", item_rows)
+        _user_db_writer.executemany(
+            "INSERT INTO users (user_id, profit_loss, cases_opened) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET profit_loss = excluded.profit_loss, cases_opened = excluded.cases_opened",
+            ((uid, profit_loss, cases_opened) for uid, profit_loss, cases_opened, _ in rows)
+        )
+        _user_db_writer.executemany(
+            "INSERT OR REPLACE INTO inventory (user_id, item_id, count) VALUES (?, ?, ?)",
+            ((uid, _db_item_id_for[item_id], count) for uid, _, _, items in rows for item_id, count in items.items())
+        )
+
+def _mark_user_dirty(user_id: int, item_id: Optional[int] = None):
+    """Records that a user changed so the next flush writes them."""
+    changed_items = _dirty_users.setdefault(user_id, set())
+    if item_id is not None:
+        changed_items.add(item_id)
+
+def _append_journal(op: str, user_id: int, **fields):
+    """Queues a delta record for the journal (journal mode only)."""
+    global _journal_seq
+    if USER_DATA_BACKEND != "journal":
+        return
+    _journal_seq += 1
+    record = {"seq": _journal_seq, "op": op, "uid": user_id, **fields}
+    _pending_journal_lines.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+def _replace_file(path: str, chunks):
+    """Writes byte/str chunks to `path` atomically: temp file, fsync, rename over the old one."""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+def _write_json_snapshot(path: str, fragments, items: List[str], journal_seq: int):
+    """Writes a version 2 JSON snapshot from {user_id: JSON fragment}."""
+    _replace_file(path, (
+        f'{{"version":{USER_DATA_SNAPSHOT_VERSION},"_journal_seq":{journal_seq},"items":',
+        json.dumps(items, ensure_ascii=False, separators=(',', ':')),
+        ',"users":{',
+        ",".join(f'"{uid}":{fragment}' for uid, fragment in fragments.items()),
+        "}}",
+    ))
+
+def _binary_snapshot_columns(fragments) -> tuple:
+    """Builds the binary snapshot's column arrays from {user_id: packed row} (runs in the worker)."""
+    user_ids, profit_losses, cases_opened = array('q'), array('d'), array('q')
+    offsets, inventory_ids, inventory_counts = array('Q', [0]), array('I'), array('I')
+    head_size = _BINARY_ROW_HEAD.size
+    for uid, row in fragments.items():
+        profit_loss, opened = _BINARY_ROW_HEAD.unpack_from(row)
+        split = head_size + (len(row) - head_size) // 2
+        user_ids.append(uid)
+        profit_losses.append(profit_loss)
+        cases_opened.append(opened)
+        inventory_ids.frombytes(row[head_size:split])
+        inventory_counts.frombytes(row[split:])
+        offsets.append(len(inventory_ids))
+    return (user_ids, profit_losses, cases_opened, offsets, inventory_ids, inventory_counts)
+
+def _write_binary_snapshot(path: str, fragments, items: List[str], journal_seq: int):
+    """Writes a binary snapshot from per-user packed rows (see UserRecord.snapshot_fragment)."""
+    columns = _binary_snapshot_columns(fragments)
+    user_ids, inventory_ids = columns[0], columns[4]
+    if sys.byteorder == "big":
+        for column in columns:
+            column.byteswap()
+    names = "\n".join(items).encode('utf-8')
+    header = _BINARY_SNAPSHOT_HEADER.pack(
+        _BINARY_SNAPSHOT_MAGIC, _BINARY_SNAPSHOT_VERSION, journal_seq,
+        len(items), len(user_ids), len(inventory_ids), len(names)
+    )
+    _replace_file(path, (header, names, *(column.tobytes() for column in columns)))
+
+def _capture_snapshot():
+    """Captures what the snapshot writer needs, on the event loop: a copy of the fragment cache.
+    Only references are copied; the worker does all serialization."""
+    return _snapshot_fragments.copy()
+
+def _write_snapshot(snapshot, items: List[str], journal_seq: int):
+    """Writes a _capture_snapshot() result in the configured format."""
+    if USER_DATA_SNAPSHOT_FORMAT == "binary":
+        _write_binary_snapshot(USER_DATA_BINARY_FILE, snapshot, items, journal_seq)
+    else:
+        _write_json_snapshot(USER_DATA_FILE, snapshot, items, journal_seq)
+
+def _write_journal_and_maybe_compact(lines, snapshot, items: List[str], journal_seq: int):
+    """Appends queued journal lines; when a snapshot is given, folds everything into a new snapshot file."""
+    global _journal_handle
+    if lines:
+        if _journal_handle is None:
+            _journal_handle = open(USER_DATA_JOURNAL_FILE, 'a', encoding='utf-8')
+            _journal_handle.write("\n") # Ends a line torn by a crash or failed write (blank lines are skipped)
+        try:
+            _journal_handle.write("".join(lines))
+            _journal_handle.flush()
+        except Exception:
+            # The lines are retried by the next flush, through a fresh handle
+            try:
+                _journal_handle.close()
+            except OSError:
+                pass
+            _journal_handle = None
+            raise
+    if snapshot is not None:
+        _write_snapshot(snapshot, items, journal_seq)
+        # Records up to journal_seq are in the snapshot now, start an empty journal
+        if _journal_handle is not None:
+            _journal_handle.close()
+        _journal_handle = open(USER_DATA_JOURNAL_FILE, 'w', encoding='utf-8')
+
+def _prepare_user_data_flush():
+    """Captures everything that needs writing and returns a callable doing the actual I/O.
+
+    Runs on the event loop and only touches dirty users; the returned callable is safe to run
+    in a worker thread because it works on copies. Returns None when there is nothing to write.
+    """
+    global _pending_journal_lines, _flushing_journal_lines, _flushing_compaction_count, _journal_records_since_compaction
+    if not _dirty_users and not _pending_journal_lines:
+        return None
+    # Anything still in _flushing_users belongs to a write that never reported back (cancelled
+    # at shutdown); writing it again is harmless and journal replay skips repeated records
+    for uid, changed_items in _dirty_users.items():
+        _flushing_users.setdefault(uid, set()).update(changed_items)
+    _dirty_users.clear()
+    dirty = {uid: set(changed_items) for uid, changed_items in _flushing_users.items()}
+
+    if USER_DATA_BACKEND == "sqlite":
+        rows = []
+        for uid, changed_items in dirty.items():
+            record = user_data[uid]
+            rows.append((uid, record.profit_loss, record.cases_opened, {item_id: record.inventory[item_id] for item_id in changed_items}))
+        item_rows = _assign_db_item_ids({item_id for row in rows for item_id in row[3]})
+        return lambda: _write_user_db_rows(rows, item_rows)
+
+    for uid in dirty:
+        _snapshot_fragments[uid] = user_data[uid].snapshot_fragment()
+    # IDs are append-only, so a copy of the name table now is valid for every captured record
+    items = item_names[:]
+    if USER_DATA_BACKEND == "json":
+        snapshot = _capture_snapshot()
+        return lambda: _write_snapshot(snapshot, items, 0)
+
+    _flushing_journal_lines += _pending_journal_lines
+    _pending_journal_lines = []
+    lines = _flushing_journal_lines[:]
+    _flushing_compaction_count = _journal_records_since_compaction
+    _journal_records_since_compaction += len(lines)
+    snapshot = None
+    if _journal_records_since_compaction >= JOURNAL_COMPACT_THRESHOLD:
+        snapshot = _capture_snapshot()
+        _journal_records_since_compaction = 0
+    journal_seq = _journal_seq
+    return lambda: _write_journal_and_maybe_compact(lines, snapshot, items, journal_seq)
+
+def _run_user_data_flush(job) -> bool:
+    """Executes a prepared flush job (in a worker thread or, at shutdown, inline). Returns True if it succeeded."""
+    with _flush_lock:
+        try:
+            job()
+            return True
+        except Exception as e:
+            print(f"Error saving user data: {e}. Will retry on the next save.")
+            return False
 
-def get_user_data_entry(user_id: int):
-    """Gets the data entry for a user, initializing if needed."""
+def _finish_user_data_flush(succeeded: bool):
+    """Runs on the event loop after a flush job: forgets what was written, or requeues it if the write failed."""
+    global _pending_journal_lines, _flushing_journal_lines, _journal_records_since_compaction
+    if not succeeded:
+        for uid, changed_items in _flushing_users.items():
+            _dirty_users.setdefault(uid, set()).update(changed_items)
+        _pending_journal_lines = _flushing_journal_lines + _pending_journal_lines
+        # The requeued lines are counted again (and a failed compaction retried) when they are next flushed
+        _journal_records_since_compaction = _flushing_compaction_count
+    _flushing_users.clear()
+    _flushing_journal_lines = []
+
+def save_user_data():
+    """Synchronously writes all pending user data changes (used at shutdown)."""
+    job = _prepare_user_data_flush()
+    if job is not None:
+        _finish_user_data_flush(_run_user_data_flush(job))
+
+def schedule_user_data_save():
+    """Asks the background flusher to persist pending changes soon.
+
+    Falls back to a synchronous save when the flusher is not running (e.g. before setup).
+    """
+    if _flusher_task is None or _flusher_task.done():
+        save_user_data()
+        return
+    _flush_event.set()
+
+async def _user_data_flusher():
+    """Background task: coalesces saves into at most one write per USER_DATA_FLUSH_INTERVAL."""
+    while True:
+        await _flush_event.wait()
+        _flush_event.clear()
+        job = _prepare_user_data_flush()
+        if job is not None:
+            succeeded = await asyncio.to_thread(_run_user_data_flush, job)
+            _finish_user_data_flush(succeeded)
+            if not succeeded:
+                _flush_event.set() # Retry after the interval
+            if USER_DATA_BACKEND == "sqlite":
+                _evict_clean_users() # Users that were pinned by pending writes may go now
+        await asyncio.sleep(USER_DATA_FLUSH_INTERVAL)
+
+def start_user_data_flusher():
+    """Starts the background flusher on the running event loop (idempotent)."""
+    global _flush_event, _flusher_task
+    if _flusher_task is not None and not _flusher_task.done():
+        return
+    _flush_event = asyncio.Event()
+    _flusher_task = asyncio.get_running_loop().create_task(_user_data_flusher())
+    if _dirty_users or _pending_journal_lines:
+        _flush_event.set()
+
+def stop_user_data_flusher():
+    """Stops the background flusher and writes anything still pending."""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    save_user_data()
+
+def _evict_clean_users(keep_user_id: Optional[int] = None):
+    """Drops the least recently used users beyond USER_CACHE_SIZE (sqlite backend).
+
+    Users with unwritten changes (and keep_user_id, the one just loaded) are skipped.
+    """
+    excess = len(user_data) - USER_CACHE_SIZE
+    if excess <= 0:
+        return
+    # Pinned users are the only ones that can be skipped, so this many oldest keys always suffice
+    scan_limit = excess + len(_dirty_users) + len(_flushing_users) + 1
+    evictable = [uid for uid in itertools.islice(user_data, scan_limit)
+                 if uid not in _dirty_users and uid not in _flushing_users and uid != keep_user_id]
+    for uid in evictable[:excess]:
+        _untrack_inventory(uid, user_data.pop(uid))
+
+def get_user_data_entry(user_id: int) -> UserRecord:
+    """Gets the record for a user, initializing (or loading it from the database) if needed."""
     global user_data
-    if user_id not in user_data:
-        user_data[user_id] = {"inventory": {}, "profit_loss": 0.0, "cases_opened": 0}
-    # Ensure existing users also have the cases_opened key
-    elif "cases_opened" not in user_data[user_id]:
-         user_data[user_id]["cases_opened"] = 0
-    return user_data[user_id]
+    user_record = user_data.get(user_id)
+    if user_record is None:
+        user_record = UserRecord()
+        if USER_DATA_BACKEND == "sqlite":
+            row = _user_db.execute("SELECT profit_loss, cases_opened FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is not None:
+                user_record.profit_loss, user_record.cases_opened = row
+                user_record.inventory = {
+                    _item_id_for_db[db_item_id]: count
+                    for db_item_id, count in _user_db.execute("SELECT item_id, count FROM inventory WHERE user_id = ?", (user_id,))
+                }
+                _track_inventory(user_id, user_record)
+        user_data[user_id] = user_record
+        if USER_DATA_BACKEND == "sqlite":
+            _evict_clean_users(keep_user_id=user_id)
+    elif USER_DATA_BACKEND == "sqlite":
+        user_data.move_to_end(user_id) # Most recently used
+    return user_record
 
 def update_user_score(user_id: int, amount: float):
     """Adds/subtracts an amount from the user's profit_loss score."""
-    user_entry = get_user_data_entry(user_id)
-    user_entry["profit_loss"] = user_entry.get("profit_loss", 0.0) + amount
+    user_record = get_user_data_entry(user_id)
+    user_record.profit_loss += amount
+    _mark_user_dirty(user_id)
+    _update_leaderboards(user_id, user_record)
+    _append_journal("score", user_id, amount=amount)
     # Saving happens after all updates in the command usually
 
 def add_item_to_user_inventory(user_id: int, item_name: str):
     """Adds an item to a user's inventory."""
-    user_entry = get_user_data_entry(user_id)
-    inventory = user_entry.get("inventory", {})
-    inventory[item_name] = inventory.get(item_name, 0) + 1
-    user_entry["inventory"] = inventory
+    user_record = get_user_data_entry(user_id)
+    item_id = intern_item(item_name)
+    _add_inventory_items(user_id, user_record, item_id, 1)
+    _mark_user_dirty(user_id, item_id)
+    _append_journal("item", user_id, item=item_name)
     # Saving happens after all updates
 
 def increment_cases_opened(user_id: int):
     """Increments the cases opened counter for a user."""
-    user_entry = get_user_data_entry(user_id)
-    user_entry["cases_opened"] = user_entry.get("cases_opened", 0) + 1
+    user_record = get_user_data_entry(user_id)
+    user_record.cases_opened += 1
+    _mark_user_dirty(user_id)
+    _update_leaderboards(user_id, user_record)
+    _append_journal("opened", user_id)
     # Saving happens after all updates
 
+def record_case_batch(user_id: int, cases_opened: int, amount: float, items: dict):
+    """Applies a multi-open in one step: cases opened, net score change and {item_name: count} won."""
+    user_record = get_user_data_entry(user_id)
+    user_record.cases_opened += cases_opened
+    user_record.profit_loss += amount
+    _mark_user_dirty(user_id)
+    for item_name, count in items.items():
+        item_id = intern_item(item_name)
+        _add_inventory_items(user_id, user_record, item_id, count)
+        _mark_user_dirty(user_id, item_id)
+    _update_leaderboards(user_id, user_record)
+    _append_journal("batch", user_id, opened=cases_opened, amount=amount, items=items) # One record for the whole batch
+
+def get_leaderboard(sort_by_cases: bool, count: int) -> List[tuple]:
+    """Returns the top `count` (user_id, profit_loss, cases_opened) rows of active users.
+
+    Users who have never opened a case and have zero profit/loss are left out.
+    """
+    sort_index = 2 if sort_by_cases else 1
+    if USER_DATA_BACKEND == "sqlite":
+        order_column = "cases_opened" if sort_by_cases else "profit_loss"
+        # Users with unwritten changes may rank differently than their rows say, overlay them
+        pending = {uid: user_data[uid] for uid in (*_dirty_users, *_flushing_users) if uid in user_data}
+        # ORDER BY ... LIMIT walks the matching index from the top instead of sorting everything
+        rows = _user_db.execute(
+            "SELECT user_id, profit_loss, cases_opened FROM users "
+            "WHERE cases_opened > 0 OR profit_loss != 0 "
+            f"ORDER BY {order_column} DESC LIMIT ?",
+            (count + len(pending),)
+        ).fetchall()
+        candidates = {uid: (uid, profit_loss, cases_opened) for uid, profit_loss, cases_opened in rows}
+        for uid, record in pending.items():
+            candidates[uid] = (uid, record.profit_loss, record.cases_opened)
+        leaderboard_data = [row for row in candidates.values() if row[2] > 0 or row[1] != 0.0]
+        return heapq.nlargest(count, leaderboard_data, key=lambda x: x[sort_index])
+
+    # The indexes are kept sorted as scores change, so this only reads the top `count` entries
+    index = leaderboard_by_cases if sort_by_cases else leaderboard_by_profit
+    return [(uid, user_data[uid].profit_loss, user_data[uid].cases_opened) for uid in index.top(count)]
+
 def parse_price(price_str: str) -> float:
     """Parses a price string (e.g., '£1,234.56', '$5.99', '12,34€') into a float."""
     if not price_str or not isinstance(price_str, str):
@@ -146,137 +1101,707 @@ def parse_price(price_str: str) -> float:
             return 0.0
 
 
+# --- Helper Functions ---
+class AliasSampler:
+    """Draws keys of a {key: weight} dict in O(1) per draw (Vose's alias method).
+
+    Build once per weight table; `choice()` draws one key, `sample(n)` a list of n keys.
+    """
+    def __init__(self, weighted_dict: dict):
+        self.keys = list(weighted_dict)
+        count = len(self.keys)
+        weights = [max(float(weight), 0.0) for weight in weighted_dict.values()]
+        total_weight = sum(weights)
+        if count and total_weight <= 0:
+            print("Warning: Invalid weights in AliasSampler, falling back to uniform.")
+            weights, total_weight = [1.0] * count, float(count)
+
+        # Scale so the average column is 1, then pair each short column with a tall one
+        scaled = [weight * count / total_weight for weight in weights] if count else []
+        self._prob = [1.0] * count
+        self._alias = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            short, tall = small.pop(), large.pop()
+            self._prob[short] = scaled[short]
+            self._alias[short] = tall
+            scaled[tall] -= 1.0 - scaled[short]
+            (small if scaled[tall] < 1.0 else large).append(tall)
+        # Whatever is left is 1 up to rounding error and keeps prob 1.0
+
+    def choice(self):
+        """Draws one key (None if there are no keys)."""
+        if not self.keys:
+            return None
+        # One uniform number picks the column (integer part) and the coin flip (fraction)
+        u = random.random() * len(self.keys)
+        column = int(u)
+        return self.keys[column] if u - column < self._prob[column] else self.keys[self._alias[column]]
+
+    def sample(self, n: int) -> list:
+        """Draws n keys independently (with replacement)."""
+        if not self.keys:
+            return []
+        keys, prob, alias, count = self.keys, self._prob, self._alias, len(self.keys)
+        rand = random.random
+        draws = []
+        for _ in range(n):
+            u = rand() * count
+            column = int(u)
+            draws.append(keys[column] if u - column < prob[column] else keys[alias[column]])
+        return draws
+
+
+# --- Case Name Lookup ---
+def normalize_case_name(name: str) -> str:
+    """Lowercase, '&' as 'and', punctuation dropped, single spaces ('Dreams & Nightmares' -> 'dreams and nightmares')."""
+    name = name.lower().replace("&", " and ")
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name).split())
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, giving up (returning limit + 1) once it must exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class CaseNameIndex:
+    """Resolves user-typed case names: exact, prefix, substring, then typo-tolerant matches.
+
+    Built once per catalog. Every case is indexed under its normalized name, the name without
+    a trailing "case", a space-free form and any "aliases" listed in its data; fuzzy lookups
+    only compare against keys sharing trigrams with the query.
+    """
+    def __init__(self, cases: dict):
+        self._keys = {} # normalized key -> case name
+        for case_name, case_data in cases.items():
+            normalized = normalize_case_name(case_name)
+            keys = {normalized, normalized.replace(" ", "")}
+            if normalized.endswith(" case"):
+                short = normalized[:-len(" case")]
+                keys.update({short, short.replace(" ", "")})
+            for alias in case_data.get("aliases", ()):
+                keys.add(normalize_case_name(alias))
+            for key in keys:
+                if key:
+                    self._keys.setdefault(key, case_name) # First case wins a clashing alias
+        self._sorted_keys = sorted(self._keys) # For prefix ranges
+        self._trigrams = {} # trigram -> keys containing it
+        for key in self._keys:
+            for trigram in self._key_trigrams(key):
+                self._trigrams.setdefault(trigram, set()).add(key)
+        # Autocomplete: every word-start suffix of every key ("nightmares case" for "dreams and
+        # nightmares case"), sorted, so typing any word of a name finds it with one bisect
+        completions = set()
+        for key, case_name in self._keys.items():
+            words = key.split(" ")
+            for i in range(len(words)):
+                completions.add((" ".join(words[i:]), i > 0, case_name))
+        self._completions = sorted(completions)
+        self._case_order = list(cases) # Catalog order, shown before anything is typed
+
+    @staticmethod
+    def _key_trigrams(key: str) -> set:
+        padded = f"  {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def resolve(self, query: str):
+        """Returns (case name or None, how it matched, ranked suggestions).
+
+        The match kind is "exact", "prefix", "substring" or "fuzzy"; a case name is only returned
+        when the match is unambiguous, otherwise the suggestions list the likeliest cases.
+        """
+        key = normalize_case_name(query)
+        if not key:
+            return None, None, []
+        if key in self._keys:
+            return self._keys[key], "exact", []
+
+        start = bisect.bisect_left(self._sorted_keys, key)
+        prefix_cases = self._unique_cases(k for k in itertools.takewhile(lambda k: k.startswith(key), self._sorted_keys[start:]))
+        if prefix_cases:
+            return (prefix_cases[0], "prefix", []) if len(prefix_cases) == 1 else (None, "prefix", prefix_cases[:CASE_SUGGESTION_LIMIT])
+
+        # Substring candidates must contain all of the query's inner trigrams
+        inner_trigrams = [key[i:i + 3] for i in range(len(key) - 2)]
+        candidates = set.intersection(*(self._trigrams.get(t, set()) for t in inner_trigrams)) if inner_trigrams else self._keys
+        substring_cases = self._unique_cases(k for k in sorted(candidates, key=len) if key in k)
+        if substring_cases:
+            return (substring_cases[0], "substring", []) if len(substring_cases) == 1 else (None, "substring", substring_cases[:CASE_SUGGESTION_LIMIT])
+
+        # Typos: rank keys sharing the most trigrams, then check their edit distance
+        shared = Counter(k for t in self._key_trigrams(key) for k in self._trigrams.get(t, ()))
+        limit = max(1, len(key) // 4)
+        scored = sorted((_edit_distance(key, candidate, limit), candidate) for candidate, _ in shared.most_common(CASE_FUZZY_CANDIDATES))
+        best_distance = {} # case name -> closest key's distance, closest cases first
+        for distance, candidate in scored:
+            if distance <= limit:
+                best_distance.setdefault(self._keys[candidate], distance)
+        ranked = list(best_distance)
+        if not ranked:
+            return None, None, []
+        if len(ranked) == 1 or best_distance[ranked[0]] < best_distance[ranked[1]]:
+            return ranked[0], "fuzzy", []
+        return None, "fuzzy", ranked[:CASE_SUGGESTION_LIMIT]
+
+    def complete(self, query: str, limit: int = 25) -> List[str]:
+        """Case names for an autocomplete box: names starting with the query, then names with a word
+        starting with it, then typo suggestions. O(log n + limit) for the prefix part.
+        """
+        key = normalize_case_name(query)
+        if not key:
+            return self._case_order[:limit]
+        start = bisect.bisect_left(self._completions, (key,))
+        window = self._completions[start:start + limit * 8] # Enough entries to fill `limit` after duplicates
+        by_name_start, by_word_start = [], []
+        for completion, mid_word, case_name in itertools.takewhile(lambda entry: entry[0].startswith(key), window):
+            (by_word_start if mid_word else by_name_start).append(case_name)
+        names = list(dict.fromkeys(by_name_start + by_word_start))
+        if len(names) < limit:
+            case_name, _, suggestions = self.resolve(query) # Typos
+            names = list(dict.fromkeys(names + ([case_name] if case_name else []) + suggestions))
+        return names[:limit]
+
+    def _unique_cases(self, keys) -> List[str]:
+        """Case names for `keys`, deduplicated in order."""
+        return list(dict.fromkeys(self._keys[k] for k in keys))
+
+
+# --- Case Catalog ---
+# The cases are read from CASE_CATALOG_FILE:
+#   {"condition_chances": {condition suffix: chance, ...},
+#    "cases": {case name: {"cost": price, "contents": {rarity: [base skin name, ...]},
+#                          "weights": {rarity: weight}, "aliases": [other name, ...] (optional)}}}
+# A drop is a base skin name plus a condition suffix, e.g. "AK-47 | Slate" + " (Field-Tested)".
+# Each load is validated and compiled into a new CaseCatalog which replaces the live one in a
+# single assignment. Commands take `catalog = case_catalog` once and use only that, so an open
+# that is still waiting on Steam when the file is reloaded finishes against the old catalog.
+def _is_weight(value) -> bool:
+    """A finite number >= 0 (JSON true/false don't count)."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) and value >= 0
+
+def validate_case_catalog(data) -> List[str]:
+    """Checks parsed catalog JSON, returning one message per problem (empty if it can be used)."""
+    if not isinstance(data, dict):
+        return ["The catalog must be a JSON object."]
+    errors = []
+    chances = data.get("condition_chances")
+    if not isinstance(chances, dict) or not chances:
+        errors.append("'condition_chances' must be a non-empty object of {condition suffix: chance}.")
+    elif not all(_is_weight(chance) for chance in chances.values()) or sum(chances.values()) <= 0:
+        errors.append("'condition_chances' must all be numbers >= 0, at least one above 0.")
+
+    cases = data.get("cases")
+    if not isinstance(cases, dict):
+        errors.append("'cases' must be an object of {case name: case}.")
+        return errors
+    for case_name, case_data in cases.items():
+        where = f"Case '{case_name}'"
+        if not case_name.strip():
+            errors.append("Case names can't be blank.")
+        if not isinstance(case_data, dict):
+            errors.append(f"{where} must be an object.")
+            continue
+        cost = case_data.get("cost")
+        if not _is_weight(cost) or cost <= 0:
+            errors.append(f"{where}: 'cost' must be a number above 0.")
+        contents, weights = case_data.get("contents"), case_data.get("weights")
+        if not isinstance(contents, dict) or not isinstance(weights, dict):
+            errors.append(f"{where}: 'contents' and 'weights' must be objects keyed by rarity.")
+            continue
+        for rarity, skins in contents.items():
+            if not isinstance(skins, list) or not all(isinstance(skin, str) and skin.strip() for skin in skins):
+                errors.append(f"{where}: contents of '{rarity}' must be a list of skin names.")
+        for rarity, weight in weights.items():
+            if not _is_weight(weight):
+                errors.append(f"{where}: weight of '{rarity}' must be a number >= 0.")
+            elif weight > 0 and not contents.get(rarity):
+                errors.append(f"{where}: '{rarity}' has a weight but no skins in contents.")
+        if not any(_is_weight(weight) and weight > 0 for weight in weights.values()):
+            errors.append(f"{where}: at least one rarity needs a weight above 0.")
+        aliases = case_data.get("aliases", [])
+        if not isinstance(aliases, list) or not all(isinstance(alias, str) for alias in aliases):
+            errors.append(f"{where}: 'aliases' must be a list of names.")
+    return errors
+
+
+class CaseCatalog:
+    """One validated version of the catalog plus everything compiled from it.
+
+    Never changed after construction: the rarity samplers, the wear sampler, the name index and
+    each case's drop table (with every drop interned, so item IDs exist before anyone unboxes
+    them) all describe exactly `cases` and `condition_chances`.
+    """
+    def __init__(self, cases: dict, condition_chances: dict, version: int):
+        self.cases = cases
+        self.condition_chances = condition_chances
+        self.version = version # Results derived from the catalog (EV estimates) are keyed on this
+        self.rarity_samplers = {name: AliasSampler(data.get("weights") or {}) for name, data in cases.items()}
+        self.wear_sampler = AliasSampler(condition_chances)
+        self.name_index = CaseNameIndex(cases)
+        self.drop_tables = {name: self._drop_table(data) for name, data in cases.items()}
+
+    def _drop_table(self, case_data: dict) -> List[tuple]:
+        """Every possible drop of a case as (item_name, probability), probabilities summing to 1."""
+        weights = case_data.get("weights") or {}
+        contents = case_data.get("contents") or {}
+        # Only rarities that can actually drop something count, like the samplers' config checks
+        total_weight = sum(weight for rarity, weight in weights.items() if contents.get(rarity) and weight > 0)
+        total_wear = sum(self.condition_chances.values())
+        if total_weight <= 0 or total_wear <= 0:
+            return []
+        table = []
+        for rarity, skins in contents.items():
+            rarity_weight = weights.get(rarity, 0.0)
+            if not skins or rarity_weight <= 0:
+                continue
+            for base_skin in skins:
+                for condition_suffix, chance in self.condition_chances.items():
+                    item_name = item_names[intern_item(f"{base_skin}{condition_suffix}")]
+                    table.append((item_name, rarity_weight / total_weight / len(skins) * chance / total_wear))
+        return table
+
+case_catalog = CaseCatalog({}, {}, 0) # The live catalog, replaced whole by install_case_catalog()
+_case_catalog_mtime = None # Modification time of the file the live catalog was read from
+_case_catalog_watch_task: Optional[asyncio.Task] = None
+
+def _case_catalog_file_mtime() -> Optional[int]:
+    try:
+        return os.stat(CASE_CATALOG_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+def read_case_catalog():
+    """Reads, validates and compiles CASE_CATALOG_FILE. Returns (CaseCatalog or None, problems)."""
+    try:
+        with open(CASE_CATALOG_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None, [f"{CASE_CATALOG_FILE} not found."]
+    except (OSError, ValueError) as e:
+        return None, [f"Could not read {CASE_CATALOG_FILE}: {e}"]
+    errors = validate_case_catalog(data)
+    if errors:
+        return None, errors
+    return CaseCatalog(data["cases"], data["condition_chances"], case_catalog.version + 1), []
+
+def install_case_catalog(catalog: CaseCatalog):
+    """Makes `catalog` the live one (one assignment: readers see either the old or the new catalog, whole)."""
+    global case_catalog
+    case_catalog = catalog
+
+def reload_case_catalog() -> List[str]:
+    """Re-reads the catalog file and swaps it in. Returns its problems; the live catalog is kept if there are any."""
+    global _case_catalog_mtime
+    _case_catalog_mtime = _case_catalog_file_mtime() # Before reading, so a write during the read is seen next time
+    catalog, errors = read_case_catalog()
+    if errors:
+        print(f"Case catalog not loaded, keeping version {case_catalog.version}: " + " ".join(errors))
+        return errors
+    install_case_catalog(catalog)
+    print(f"Case catalog version {catalog.version} loaded: {len(catalog.cases)} cases.")
+    return []
+
+async def _case_catalog_watcher():
+    """Background task: reloads the catalog whenever its file changes."""
+    while True:
+        await asyncio.sleep(CASE_CATALOG_WATCH_INTERVAL)
+        try:
+            if _case_catalog_file_mtime() != _case_catalog_mtime:
+                reload_case_catalog()
+        except Exception as e:
+            print(f"Error while checking the case catalog file: {e}")
+
+def start_case_catalog_watcher():
+    """Starts the file watcher on the running event loop (idempotent, no-op if disabled)."""
+    global _case_catalog_watch_task
+    if CASE_CATALOG_WATCH_INTERVAL <= 0 or (_case_catalog_watch_task is not None and not _case_catalog_watch_task.done()):
+        return
+    _case_catalog_watch_task = asyncio.get_running_loop().create_task(_case_catalog_watcher())
+
+def stop_case_catalog_watcher():
+    global _case_catalog_watch_task
+    if _case_catalog_watch_task is not None:
+        _case_catalog_watch_task.cancel()
+        _case_catalog_watch_task = None
+
+
 # --- Load initial data ---
-load_user_data()
-
-# --- CS:GO Case & Item Data ---
-
-# Define conditions and their approximate chances
-# These chances are illustrative - adjust them as you see fit!
-condition_chances = {
-    " (Factory New)": 10.0,       # 10% chance
-    " (Minimal Wear)": 25.0,      # 25% chance
-    " (Field-Tested)": 40.0,      # 40% chance (Most common)
-    " (Well-Worn)": 15.0,         # 15% chance
-    " (Battle-Scarred)": 10.0,    # 10% chance
-}
-# Ensure chances sum close to 100 or normalize later if needed
-
-# Define Cases
-# NOTE: Costs are fixed examples. Contents are BASE skin names.
-# Replace with accurate data from reliable sources.
-all_cases = {
-    "Original Mix Case": {
-        "cost": 2.50, # Example fixed cost (Case + Key approx)
-        "contents": {
-            "Mil-Spec (Blue)": ["MAC-10 | Oceanic", "CZ75-Auto | Tacticat", "UMP-45 | Exposure"],
-            "Restricted (Purple)": ["AK-47 | The Empress", "Glock-18 | Off World"],
-            "Classified (Pink)": ["P250 | See Ya Later"],
-            "Covert (Red)": ["M4A1-S | Decimator"],
-            "Rare Special Item (Gold)": ["★ Karambit | Lore"] # Base knife name
-        },
-        "weights": { # Standard CS:GO odds
-            "Mil-Spec (Blue)": 79.92327, "Restricted (Purple)": 15.98465, "Classified (Pink)": 3.19693,
-            "Covert (Red)": 0.63939, "Rare Special Item (Gold)": 0.25576
-        }
-    },
-    "Revolution Case": {
-        "cost": 1.50, # Example cost
-        "contents": { # EXAMPLE CONTENTS - REPLACE WITH REAL DATA
-            "Mil-Spec (Blue)": ["MP9 | Featherweight", "P250 | Re.built", "MAG-7 | Insomnia"],
-            "Restricted (Purple)": ["Glock-18 | Umbral Rabbit", "MAC-10 | Sakkaku"],
-            "Classified (Pink)": ["R8 Revolver | Banana Cannon", "P90 | Neoqueen"],
-            "Covert (Red)": ["AK-47 | Head Shot", "M4A4 | Temukau"],
-            "Rare Special Item (Gold)": ["★ Specialist Gloves | Kimono"] # Base glove name
-        },
-        "weights": { # Standard CS:GO odds
-            "Mil-Spec (Blue)": 79.92327, "Restricted (Purple)": 15.98465, "Classified (Pink)": 3.19693,
-            "Covert (Red)": 0.63939, "Rare Special Item (Gold)": 0.25576
-        }
-    },
-    "Dreams & Nightmares Case": {
-        "cost": 0.80, # Example cost
-        "contents": { # EXAMPLE CONTENTS - REPLACE WITH REAL DATA
-            "Mil-Spec (Blue)": ["Five-SeveN | Scrawl", "SCAR-20 | Poultrygeist", "Sawed-Off | Spirit Board"],
-            "Restricted (Purple)": ["MP7 | Abyssal Apparition", "XM1014 | Zombie Offensive", "Dual Berettas | Melondrama"],
-            "Classified (Pink)": ["USP-S | Ticket to Hell", "G3SG1 | Dream Glade", "FAMAS | Rapid Eye Movement"],
-            "Covert (Red)": ["AK-47 | Nightwish", "MP9 | Starlight Protector"],
-            "Rare Special Item (Gold)": ["★ Butterfly Knife | Gamma Doppler", "★ Huntsman Knife | Lore", "★ Bowie Knife | Autotronic"] # Example multiple knives/gloves
-        },
-        "weights": { # Standard CS:GO odds
-             "Mil-Spec (Blue)": 79.92327, "Restricted (Purple)": 15.98465, "Classified (Pink)": 3.19693,
-            "Covert (Red)": 0.63939, "Rare Special Item (Gold)": 0.25576
-        }
-    },
-     "Kilowatt Case": { # EXAMPLE - NEEDS REAL DATA
-        "cost": 4.00,
-        "contents": {
-            "Mil-Spec (Blue)": ["Tec-9 | Slag", "UMP-45 | Motorized", "Dual Berettas | Hideout"],
-            "Restricted (Purple)": ["Five-SeveN | Hybrid", "MAC-10 | Light Box", "SSG 08 | Dezastre"],
-            "Classified (Pink)": ["Sawed-Off | Analog Input", "USP-S | Jawbreaker", "Zeus x27 | Olympus"],
-            "Covert (Red)": ["AK-47 | Inheritance", "M4A1-S | Black Lotus"],
-            "Rare Special Item (Gold)": ["★ Kukri Knife | Fade", "★ Kukri Knife | Slaughter", "★ Kukri Knife | Case Hardened"] # Example new knife
-        },
-        "weights": { # Standard CS:GO odds
-             "Mil-Spec (Blue)": 79.92327, "Restricted (Purple)": 15.98465, "Classified (Pink)": 3.19693,
-            "Covert (Red)": 0.63939, "Rare Special Item (Gold)": 0.25576
-        }
-    },
-    "Clutch Case": { # EXAMPLE - NEEDS REAL DATA
-        "cost": 0.50,
-        "contents": {
-            "Mil-Spec (Blue)": ["MP9 | Black Sand", "Five-SeveN | Flame Test", "P2000 | Urban Hazard"],
-            "Restricted (Purple)": ["SG 553 | Aloha", "XM1014 | Oxide Blaze", "Glock-18 | Moonrise"],
-            "Classified (Pink)": ["AWP | Mortis", "UMP-45 | Arctic Wolf", "AUG | Stymphalian"],
-            "Covert (Red)": ["M4A4 | Neo-Noir", "USP-S | Cortex"],
-            "Rare Special Item (Gold)": ["★ Hydra Gloves | Emerald", "★ Sport Gloves | Vice", "★ Driver Gloves | King Snake"] # Example gloves
-        },
-        "weights": { # Standard CS:GO odds
-             "Mil-Spec (Blue)": 79.92327, "Restricted (Purple)": 15.98465, "Classified (Pink)": 3.19693,
-            "Covert (Red)": 0.63939, "Rare Special Item (Gold)": 0.25576
-        }
-    }
-    # Add more cases here following the same structure
-    # Make sure 'contents' use BASE skin names
-}
+if not IS_POOL_WORKER:
+    if reload_case_catalog(): # Intern the catalog first so its items get the lowest IDs
+        print(f"No cases can be opened until {CASE_CATALOG_FILE} is fixed (it is reloaded automatically, or use !reloadcases).")
+    load_unit_values() # Before the users, so their inventory values start from the last known prices
+    load_user_data()
+    # Last line of defence: write anything the flusher has not picked up yet when the process exits
+    atexit.register(save_user_data)
+    atexit.register(unit_value_store.flush)
+
+# --- Steam HTTP Client ---
+def create_steam_session() -> aiohttp.ClientSession:
+    """Creates the shared Steam session: bounded per-host pool, keep-alive and timeouts."""
+    connector = aiohttp.TCPConnector(
+        limit_per_host=STEAM_MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=STEAM_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    timeout = aiohttp.ClientTimeout(total=STEAM_HTTP_TIMEOUT, connect=STEAM_HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+# --- Steam Rate Limiter ---
+class FlightPriority:
+    """Priority of a shared Steam lookup (see SingleFlight), raised when a more urgent caller joins."""
+    __slots__ = ("priority", "waiter")
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.waiter = None # The lookup's rate limiter queue entry while it waits for a token
+
+# The shared lookup the current task is running for, if any (set by SingleFlight.do)
+_steam_flight = contextvars.ContextVar("steam_flight", default=None)
+
+
+class SteamRateLimiter:
+    """Token bucket every Steam request goes through, with priority classes.
+
+    Requests take a token if one is available and nobody is queued; otherwise they wait in a
+    priority queue that a single dispatcher task drains as tokens refill, so interactive
+    lookups overtake bulk and background traffic.
+    """
+    PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk", PRIORITY_BACKGROUND: "background"}
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = [] # heap of (priority, sequence, future, enqueued_at)
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        # Per priority: [requests granted, total seconds waited, longest wait]
+        self._wait_stats = {priority: [0, 0.0, 0.0] for priority in self.PRIORITY_NAMES}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _record_wait(self, priority: int, waited: float):
+        stats = self._wait_stats.setdefault(priority, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        """Waits until a request of the given priority may be sent."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            self._record_wait(priority, 0.0)
+            return
+        flight = _steam_flight.get()
+        if flight is not None:
+            priority = min(priority, flight.priority) # Someone more urgent may have joined already
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future, now)
+        heapq.heappush(self._waiters, entry)
+        if flight is not None:
+            flight.waiter = entry
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future # Cancelling the caller cancels the future, the dispatcher then skips it
+
+    async def _dispatch(self):
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            priority, _, future, enqueued_at = heapq.heappop(self._waiters)
+            if future.done():
+                continue # Caller gave up
+            self._tokens -= 1
+            self._record_wait(priority, now - enqueued_at)
+            future.set_result(None)
+
+    def raise_priority(self, flight: FlightPriority, priority: int):
+        """A more urgent caller joined `flight`: if it is waiting for a token, it moves up the queue."""
+        if priority >= flight.priority:
+            return
+        flight.priority = priority
+        entry = flight.waiter
+        if entry is not None and not entry[2].done() and entry[0] > priority:
+            # Push it again at the new priority; the old entry is skipped once the future is done
+            flight.waiter = (priority, next(self._sequence), entry[2], entry[3])
+            heapq.heappush(self._waiters, flight.waiter)
+
+    def release(self):
+        """Gives back a token that was granted for a request that was then not sent."""
+        self._tokens = min(self.burst, self._tokens + 1)
+
+    def back_off(self, seconds: float):
+        """Pauses all requests (e.g. after Steam answered 429)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    def stats(self) -> dict:
+        """Queue depth and wait times per priority class."""
+        queued = {}
+        waiting = {} # future -> most urgent priority it is queued at (raise_priority leaves duplicates)
+        for priority, _, future, _ in self._waiters:
+            if not future.done():
+                waiting[future] = min(priority, waiting.get(future, priority))
+        for priority in waiting.values():
+            queued[priority] = queued.get(priority, 0) + 1
+        result = {}
+        for priority, (granted, total_wait, max_wait) in self._wait_stats.items():
+            result[self.PRIORITY_NAMES.get(priority, str(priority))] = {
+                "queued": queued.get(priority, 0),
+                "granted": granted,
+                "avg_wait": total_wait / granted if granted else 0.0,
+                "max_wait": max_wait,
+            }
+        return result
+
+steam_rate_limiter = SteamRateLimiter(STEAM_RATE_LIMIT, STEAM_RATE_BURST)
+
+
+# --- Steam Request Coalescing ---
+class SingleFlight:
+    """Collapses concurrent identical Steam lookups into one request.
+
+    The first caller for a key starts the fetch; anyone asking for the same key while it is
+    still running awaits the same task. Waiters are shielded, so one caller giving up (e.g. a
+    timed-out inventory recalculation) does not cancel the request for the others. A caller
+    with a more urgent priority than the flight's raises it, so an interactive lookup that
+    joins a queued bulk or background request is not served at their priority.
+    """
+    def __init__(self):
+        self._in_flight = {} # key -> (task, FlightPriority)
+        self.started = 0
+        self.collapsed = {} # key kind ("price", "image") -> callers that joined an existing request
+
+    async def do(self, key: tuple, fetch, priority: int):
+        """Returns the result of `fetch()`, shared with concurrent callers for the same key.
+
+        `priority` is this caller's; the fetch's Steam requests go out at the most urgent
+        priority of everyone waiting on it.
+        """
+        entry = self._in_flight.get(key)
+        if entry is None:
+            self.started += 1
+            flight = FlightPriority(priority)
+            context = contextvars.copy_context()
+            context.run(_steam_flight.set, flight)
+            task = asyncio.create_task(fetch(), context=context)
+            self._in_flight[key] = (task, flight)
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            task, flight = entry
+            self.collapsed[key[0]] = self.collapsed.get(key[0], 0) + 1
+            steam_rate_limiter.raise_priority(flight, priority)
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+steam_single_flight = SingleFlight()
+
+
+# --- Steam Market Price Cache ---
+class PriceCache:
+    """Process-wide cache of market prices (price strings) keyed by market_hash_name.
+
+    Fresh entries are returned as-is. Stale entries are returned immediately while a
+    background refresh runs, and when a refresh fails (Steam down, rate limited) the last
+    known price is kept rather than dropped.
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # item_name -> (price_str, fetched_at), least recently used first
+        self._refresh_tasks = {} # item_name -> background refresh task
+        self._listeners = [] # Called as listener(item_name, price_str) when a price changes
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def peek(self, item_name: str) -> Optional[str]:
+        """Returns the cached price (fresh or stale) without fetching anything."""
+        entry = self._entries.get(item_name)
+        return entry[0] if entry else None
+
+    def get_fresh(self, item_name: str) -> Optional[str]:
+        """Returns the price if it is cached and fresh (counted as a hit), otherwise None."""
+        if not self.is_fresh(item_name):
+            return None
+        self.hits += 1
+        self._entries.move_to_end(item_name)
+        return self._entries[item_name][0]
+
+    def is_fresh(self, item_name: str) -> bool:
+        entry = self._entries.get(item_name)
+        return entry is not None and time.monotonic() - entry[1] < self.ttl
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def set(self, item_name: str, price_str: str):
+        previous = self._entries.get(item_name)
+        self._entries[item_name] = (price_str, time.monotonic())
+        self._entries.move_to_end(item_name)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if previous is None or previous[0] != price_str:
+            for listener in self._listeners:
+                listener(item_name, price_str)
+
+    async def get(self, item_name: str, fetch, priority: int = PRIORITY_INTERACTIVE) -> Optional[str]:
+        """Returns the price for item_name.
+
+        `fetch(priority)` is the coroutine function that asks Steam; a miss calls it with the
+        caller's priority, a background refresh of a stale entry with PRIORITY_BACKGROUND.
+        """
+        entry = self._entries.get(item_name)
+        if entry is not None:
+            self._entries.move_to_end(item_name)
+            price_str, fetched_at = entry
+            if time.monotonic() - fetched_at < self.ttl:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._refresh_in_background(item_name, fetch)
+            return price_str
+
+        self.misses += 1
+        price_str = await fetch(priority)
+        if price_str is not None:
+            self.set(item_name, price_str)
+        return price_str
 
-# --- Helper Functions ---
-def weighted_random_choice(weighted_dict):
-    """Selects a key from a dictionary based on its value (weight)."""
-    total_weight = sum(weighted_dict.values())
-    if total_weight <= 0:
-        # Fallback if weights are invalid, maybe return a random key or None
-        if not weighted_dict: return None
-        print("Warning: Invalid weights in weighted_random_choice, falling back to random.")
-        return random.choice(list(weighted_dict.keys()))
-
-    random_num = random.uniform(0, total_weight)
-    current_weight = 0
-    for item, weight in weighted_dict.items():
-        current_weight += weight
-        if random_num <= current_weight:
-            return item
-    # Should not be reached if total_weight > 0, but as a fallback:
-    return random.choice(list(weighted_dict.keys())) if weighted_dict else None
-
-async def get_steam_market_data(item_name: str, session: requests.Session) -> Optional[dict]:
-    """Fetches price overview data from Steam Market asynchronously using a session."""
-    url = "https://steamcommunity.com/market/priceoverview/"
+    def _refresh_in_background(self, item_name: str, fetch):
+        if item_name in self._refresh_tasks:
+            return # Already refreshing
+        task = asyncio.create_task(self._refresh(item_name, fetch))
+        self._refresh_tasks[item_name] = task
+        task.add_done_callback(lambda _: self._refresh_tasks.pop(item_name, None))
+
+    async def _refresh(self, item_name: str, fetch):
+        try:
+            price_str = await fetch(PRIORITY_BACKGROUND)
+        except Exception as e:
+            print(f"Error refreshing cached price for {item_name}: {e}")
+            return
+        if price_str is not None:
+            self.set(item_name, price_str)
+        # On failure the stale entry stays, so callers keep getting the last known price
+
+price_cache = PriceCache(PRICE_CACHE_TTL, PRICE_CACHE_MAX_ENTRIES)
+price_cache.add_listener(_on_price_change) # Keeps every in-memory inventory value current
+
+
+class ImageUrlCache:
+    """Persistent skin name -> image URL cache, backed by a small sqlite table.
+
+    Found URLs never expire. "No image" results are kept for `negative_ttl` seconds so a
+    missing listing is not re-scraped on every unbox. All rows are read into memory on open,
+    lookups never touch the disk.
+    """
+    def __init__(self, db_file: str, negative_ttl: float):
+        self.db_file = db_file
+        self.negative_ttl = negative_ttl
+        self._entries = {} # skin_name -> (image_url or None, fetched_at as a unix timestamp)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        """Opens (creating if needed) the cache database and loads every entry."""
+        try:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS image_urls (
+                    skin_name TEXT PRIMARY KEY,
+                    image_url TEXT,
+                    fetched_at REAL NOT NULL
+                )
+            """)
+            for skin_name, image_url, fetched_at in self._db.execute("SELECT skin_name, image_url, fetched_at FROM image_urls"):
+                self._entries[skin_name] = (image_url, fetched_at)
+            print(f"Image URL cache loaded ({len(self._entries)} entries).")
+        except sqlite3.Error as e:
+            print(f"Could not open image URL cache {self.db_file}: {e}. Caching in memory only.")
+            self._db = None
+
+    def lookup(self, skin_name: str):
+        """Returns (cached, image_url). A cached None means Steam had no image recently."""
+        if self.is_cached(skin_name):
+            self.hits += 1
+            return True, self._entries[skin_name][0]
+        self.misses += 1
+        return False, None
+
+    def is_cached(self, skin_name: str) -> bool:
+        """True if lookup() would answer without going to Steam (expired negatives don't count)."""
+        entry = self._entries.get(skin_name)
+        return entry is not None and (entry[0] is not None or time.time() - entry[1] < self.negative_ttl)
+
+    async def store(self, skin_name: str, image_url: Optional[str]):
+        """Remembers a lookup result, in memory right away and on disk from a worker thread."""
+        fetched_at = time.time()
+        self._entries[skin_name] = (image_url, fetched_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._write, skin_name, image_url, fetched_at)
+
+    def _write(self, skin_name: str, image_url: Optional[str], fetched_at: float):
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO image_urls (skin_name, image_url, fetched_at) VALUES (?, ?, ?)",
+                        (skin_name, image_url, fetched_at)
+                    )
+            except sqlite3.Error as e:
+                print(f"Error writing image URL cache entry for {skin_name}: {e}")
+
+image_url_cache = ImageUrlCache(IMAGE_CACHE_DB_FILE, IMAGE_CACHE_NEGATIVE_TTL)
+if not IS_POOL_WORKER:
+    image_url_cache.open()
+
+
+async def get_steam_market_data(item_name: str, session: aiohttp.ClientSession, priority: int = PRIORITY_INTERACTIVE) -> Optional[dict]:
+    """Fetches price overview data from Steam Market asynchronously using the shared session."""
+    url = f"{STEAM_COMMUNITY_URL}/market/priceoverview/"
     params = {"currency": 2, "appid": 730, "market_hash_name": item_name } # Currency 2 = GBP (£)
     headers = {"User-Agent": f"DiscordBot/1.0 (Market Check for {item_name})"} # More specific UA
     try:
-        # Use asyncio.to_thread for blocking requests.get within the async function
-        response = await asyncio.to_thread(session.get, url, params=params, headers=headers, timeout=10) # Add timeout
-
-        if response.status_code == 429:
-             print(f"Rate limited by Steam API for {item_name}. Waiting...")
-             await asyncio.sleep(random.uniform(5, 15)) # Wait before potential retry (if implemented)
-             return None # Indicate rate limit
-        elif response.status_code != 200:
-            print(f"Steam Price API Error {response.status_code} for {item_name}. Response: {response.text[:200]}") # Log snippet
-            return None
-
-        data = response.json()
+        await steam_rate_limiter.acquire(priority)
+        async with session.get(url, params=params, headers=headers) as response:
+            if response.status == 429:
+                 print(f"Rate limited by Steam API for {item_name}. Pausing Steam requests...")
+                 steam_rate_limiter.back_off(STEAM_RATE_LIMIT_BACKOFF) # Slows every caller, not just this one
+                 return None # Indicate rate limit
+            elif response.status != 200:
+                print(f"Steam Price API Error {response.status} for {item_name}. Response: {(await response.text())[:200]}") # Log snippet
+                return None
+            response_text = await response.text()
+
+        data = json.loads(response_text)
         if not data:
              print(f"Steam Price API returned empty data for {item_name}")
              return None
@@ -285,115 +1810,732 @@ async def get_steam_market_data(item_name: str, session: requests.Session) -> Op
             # print(f"Steam Price API reported failure for {item_name}: {data}")
             return None
         return data
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
          print(f"Timeout getting Steam price for {item_name}")
          return None
-    except requests.exceptions.RequestException as e:
+    except aiohttp.ClientError as e:
         print(f"Network error getting Steam price for {item_name}: {e}")
         return None
     except json.JSONDecodeError as e:
-        print(f"JSON decode error for Steam price ({item_name}): {e}. Response text: {response.text[:200]}")
+        print(f"JSON decode error for Steam price ({item_name}): {e}. Response text: {response_text[:200]}")
         return None
     except Exception as e:
         print(f"Unexpected error in get_steam_market_data for {item_name}: {e}")
         return None
 
 
-async def get_skin_price_str(item_name: str, session: requests.Session) -> Optional[str]:
-    """Gets the 'lowest_price' or 'median_price' string from Steam API."""
-    data = await get_steam_market_data(item_name, session)
-    if data:
-        # Prefer lowest_price, fall back to median_price if lowest is missing
-        return data.get("lowest_price") or data.get("median_price")
+async def get_skin_price_str(item_name: str, session: aiohttp.ClientSession, priority: int = PRIORITY_INTERACTIVE) -> Optional[str]:
+    """Gets the 'lowest_price' or 'median_price' string, from the price cache when possible."""
+    async def fetch_from_steam(fetch_priority: int):
+        data = await get_steam_market_data(item_name, session, fetch_priority)
+        if data:
+            # Prefer lowest_price, fall back to median_price if lowest is missing
+            return data.get("lowest_price") or data.get("median_price")
+        return None
+    async def fetch(fetch_priority: int):
+        # Concurrent misses (and refreshes) for the same item share one request
+        return await steam_single_flight.do(("price", item_name), lambda: fetch_from_steam(fetch_priority), fetch_priority)
+    return await price_cache.get(item_name, fetch, priority)
+
+
+def market_base_name(item_name: str) -> str:
+    """'AK-47 | Redline (Field-Tested)' -> 'AK-47 | Redline' (the part every wear shares)."""
+    if item_name.endswith(")") and " (" in item_name:
+        return item_name[:item_name.rindex(" (")]
+    return item_name
+
+
+async def _search_market(query: str, session: aiohttp.ClientSession, priority: int, count: int = MARKET_SEARCH_PAGE_SIZE, skip_if=None):
+    """Runs one market search (JSON, no rendered HTML) for CS:GO listings matching `query`.
+
+    Returns (listings, response_bytes, parse_seconds); listings is None if the request failed or
+    `skip_if()` was true by the time the rate limiter let it through.
+    """
+    url = f"{STEAM_COMMUNITY_URL}/market/search/render/"
+    params = {"query": query, "appid": 730, "norender": 1, "currency": 2,
+              "start": 0, "count": count, "search_descriptions": 0}
+    headers = {"User-Agent": f"DiscordBot/1.0 (Market Search for {query})"}
+    try:
+        await steam_rate_limiter.acquire(priority)
+        if skip_if is not None and skip_if():
+            steam_rate_limiter.release()
+            return None, 0, 0.0
+        async with session.get(url, params=params, headers=headers) as response:
+            if response.status == 429:
+                print(f"Rate limited by Steam searching for {query}. Pausing Steam requests...")
+                steam_rate_limiter.back_off(STEAM_RATE_LIMIT_BACKOFF)
+                return None, 0, 0.0
+            elif response.status != 200:
+                print(f"Steam Market Search Error {response.status} for {query}")
+                return None, 0, 0.0
+            body = await response.read()
+        parse_started = time.perf_counter()
+        data = json.loads(body)
+        parse_seconds = time.perf_counter() - parse_started
+    except asyncio.TimeoutError:
+        print(f"Timeout searching Steam market for {query}")
+        return None, 0, 0.0
+    except aiohttp.ClientError as e:
+        print(f"Network error searching Steam market for {query}: {e}")
+        return None, 0, 0.0
+    except Exception as e:
+        print(f"Unexpected error searching Steam market for {query}: {e}")
+        return None, 0, 0.0
+
+    if not data or not data.get("success"):
+        return None, len(body), parse_seconds
+    return data.get("results") or [], len(body), parse_seconds
+
+
+_market_price_search_suspended_until = 0.0 # See MARKET_SEARCH_CURRENCY_COOLDOWN
+
+def market_price_search_suspended() -> bool:
+    """True while searches are known to answer in the wrong currency (pricing then goes straight to priceoverview)."""
+    return time.monotonic() < _market_price_search_suspended_until
+
+async def search_market_prices(query: str, session: aiohttp.ClientSession, priority: int = PRIORITY_BULK) -> Optional[dict]:
+    """Prices every CS:GO listing matching `query` with one market search request.
+
+    Returns {market_hash_name: price_str} (possibly empty), or None if the request failed or
+    searches are suspended. A search whose prices are all in another currency suspends
+    searching for MARKET_SEARCH_CURRENCY_COOLDOWN, so queued searches are not sent for nothing.
+    """
+    global _market_price_search_suspended_until
+    listings, _, _ = await _search_market(query, session, priority, skip_if=market_price_search_suspended)
+    if listings is None:
+        return None
+    prices = {}
+    other_currency = False
+    for listing in listings:
+        hash_name = listing.get("hash_name")
+        price_str = listing.get("sell_price_text")
+        if hash_name and price_str:
+            if MARKET_PRICE_CURRENCY_SYMBOL in price_str:
+                prices[hash_name] = price_str
+            else:
+                other_currency = True
+        image_url = _market_listing_image_url(listing)
+        if hash_name and image_url and not image_url_cache.is_cached(hash_name):
+            await image_url_cache.store(hash_name, image_url) # Free with the price, saves a lookup later
+    if other_currency and not prices and not market_price_search_suspended():
+        print(f"Market search returned prices in another currency; using priceoverview only for {MARKET_SEARCH_CURRENCY_COOLDOWN // 60} minutes.")
+        _market_price_search_suspended_until = time.monotonic() + MARKET_SEARCH_CURRENCY_COOLDOWN
+    return prices
+
+
+async def _price_skin_group(base_name: str, item_names: List[str], session: aiohttp.ClientSession, priority: int):
+    """Prices the items of one base skin: one market search, then priceoverview for whatever it missed.
+
+    Returns (item_names, {item_name: price_str} for the items a price was found for).
+    """
+    try:
+        # One search covers every wear (and StatTrak variant) of the skin
+        result = None
+        if not market_price_search_suspended():
+            result = await steam_single_flight.do(("search", base_name), lambda: search_market_prices(base_name, session, priority), priority)
+    except Exception as e:
+        print(f"Error in bulk price search for {base_name}: {e}")
+        result = None
+    for hash_name, price_str in (result or {}).items():
+        price_cache.set(hash_name, price_str) # Cache the neighbours too, they are likely to be asked for
+
+    prices = {item_name: result[item_name] for item_name in item_names if result and item_name in result}
+    fallback = [item_name for item_name in item_names if item_name not in prices]
+    if fallback:
+        fallback_prices = await asyncio.gather(*(get_skin_price_str(item_name, session, priority) for item_name in fallback), return_exceptions=True)
+        for item_name, price_str in zip(fallback, fallback_prices):
+            if isinstance(price_str, Exception):
+                print(f"Error fetching price during bulk pricing for {item_name}: {price_str}")
+            elif price_str is not None:
+                prices[item_name] = price_str
+    return item_names, prices
+
+
+async def iter_skin_prices_bulk(item_names, session: aiohttp.ClientSession, priority: int = PRIORITY_BULK):
+    """Prices many items at once, yielding (item_names, prices) as each group finishes.
+
+    Fresh cache hits come first as one group, then one group per base skin (see _price_skin_group).
+    If the consumer stops early (e.g. a timeout), the remaining lookups keep running and still
+    land in the price cache.
+    """
+    cached = {}
+    missing_by_base = {} # base skin name -> item names still needing a price
+    for item_name in item_names:
+        price_str = price_cache.get_fresh(item_name)
+        if price_str is not None:
+            cached[item_name] = price_str
+        else:
+            missing_by_base.setdefault(market_base_name(item_name), []).append(item_name)
+    if cached:
+        yield list(cached), cached
+
+    pending = {asyncio.create_task(_price_skin_group(base_name, names, session, priority))
+               for base_name, names in missing_by_base.items()}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+async def get_skin_prices_bulk(item_names, session: aiohttp.ClientSession, priority: int = PRIORITY_BULK) -> dict:
+    """Prices many items at once: fresh cache hits, then one market search per base skin, then
+    individual priceoverview lookups for whatever the searches did not cover.
+
+    Returns {item_name: price_str} for every item a price was found for.
+    """
+    prices = {}
+    async for _, group_prices in iter_skin_prices_bulk(item_names, session, priority):
+        prices.update(group_prices)
+    return prices
+
+
+async def get_skin_image_url(skin_name: str, session: aiohttp.ClientSession, priority: int = PRIORITY_INTERACTIVE):
+    """Gets the market listing image URL for a skin, from the persistent cache when possible."""
+    cached, image_url = image_url_cache.lookup(skin_name)
+    if cached:
+        return image_url
+    async def fetch():
+        image_url = await _resolve_skin_image_url(skin_name, session, priority)
+        definitive = image_url is not None
+        if image_url is None: # Not in the search results (or the search failed), read the listing page
+            image_url, definitive = await _scrape_skin_image_url(skin_name, session, priority)
+        if definitive: # Only remember real answers, not timeouts or rate limits
+            await image_url_cache.store(skin_name, image_url)
+        return image_url
+    return await steam_single_flight.do(("image", skin_name), fetch, priority)
+
+
+def _market_listing_image_url(listing: dict) -> Optional[str]:
+    """Builds the CDN image URL from a market search listing's icon hash."""
+    icon_hash = (listing.get("asset_description") or {}).get("icon_url")
+    return f"{STEAM_ECONOMY_IMAGE_URL}{icon_hash}/{STEAM_ECONOMY_IMAGE_SIZE}" if icon_hash else None
+
+
+async def _resolve_skin_image_url(skin_name: str, session: aiohttp.ClientSession, priority: int) -> Optional[str]:
+    """Builds the image URL from the icon hash in the market search JSON (a few KB, no HTML)."""
+    listings, response_bytes, parse_seconds = await _search_market(skin_name, session, priority, count=MARKET_IMAGE_SEARCH_COUNT)
+    if listings is None:
+        return None
+    print(f"Image lookup for {skin_name}: {response_bytes} bytes of JSON, parsed in {parse_seconds * 1000:.1f}ms")
+    for listing in listings:
+        if listing.get("hash_name") == skin_name:
+            return _market_listing_image_url(listing)
     return None
 
 
-async def get_skin_image_url(skin_name: str, session: requests.Session):
-    """Gets the market listing image URL for a skin using a session."""
-    base_url = "https://steamcommunity.com/market/listings/730/"
+# --- Listing Page Extraction ---
+_listing_parse_pool = None
+# CPU time spent extracting listing pages (event loop thread + worker processes)
+listing_parse_stats = {"pages": 0, "early_exits": 0, "pool_scans": 0, "bytes": 0, "cpu_seconds": 0.0, "max_cpu_seconds": 0.0}
+
+def _get_listing_parse_pool() -> ProcessPoolExecutor:
+    global _listing_parse_pool
+    if _listing_parse_pool is None:
+        # Never fork: by now this process has event loop, resolver and sqlite threads. Fresh
+        # workers only import listing_extract (and skip this file's startup, see IS_POOL_WORKER).
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        mp_context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            mp_context.set_forkserver_preload(["listing_extract"])
+        _listing_parse_pool = ProcessPoolExecutor(max_workers=LISTING_PARSE_WORKERS, mp_context=mp_context)
+    return _listing_parse_pool
+
+def shutdown_listing_parse_pool():
+    global _listing_parse_pool
+    if _listing_parse_pool is not None:
+        _listing_parse_pool.shutdown(wait=False, cancel_futures=True)
+        _listing_parse_pool = None
+
+def _record_listing_parse(page_bytes: int, cpu_seconds: float, early_exit: bool, pool_scan: bool):
+    listing_parse_stats["pages"] += 1
+    listing_parse_stats["early_exits"] += early_exit
+    listing_parse_stats["pool_scans"] += pool_scan
+    listing_parse_stats["bytes"] += page_bytes
+    listing_parse_stats["cpu_seconds"] += cpu_seconds
+    listing_parse_stats["max_cpu_seconds"] = max(listing_parse_stats["max_cpu_seconds"], cpu_seconds)
+
+def _absolute_image_url(src: str) -> str:
+    # Sometimes the src is relative, sometimes absolute
+    if not src.startswith("http"):
+        # Fallback if structure changes, try constructing absolute URL
+        # This might need adjustment if Steam changes CDN path
+        return "https://steamcommunity-a.akamaihd.net/economy/image/" + src
+    return src # Already absolute URL
+
+
+async def _scrape_skin_image_url(skin_name: str, session: aiohttp.ClientSession, priority: int):
+    """Scrapes the image URL from the market listing page.
+
+    Returns (image_url, definitive): definitive is False when the lookup failed for a
+    transient reason (rate limit, timeout, server error) and should not be cached.
+    """
+    base_url = f"{STEAM_COMMUNITY_URL}/market/listings/730/"
     # Ensure the skin name is URL encoded
     skin_url = base_url + urllib.parse.quote(skin_name)
     headers = {"User-Agent": f"DiscordBot/1.0 (Market Image Check for {skin_name})"}
     try:
-        # Use asyncio.to_thread for blocking requests.get within the async function
-        response = await asyncio.to_thread(session.get, skin_url, headers=headers, timeout=10) # Add timeout
-
-        if response.status_code == 429:
-             print(f"Rate limited by Steam getting image for {skin_name}. Waiting...")
-             await asyncio.sleep(random.uniform(5, 15))
-             return None # Indicate rate limit
-        elif response.status_code != 200:
-            # Don't spam for 404s, but log other errors
-            if response.status_code != 404:
-                print(f"Steam Market Error {response.status_code} getting image page for {skin_name}")
-            return None
+        await steam_rate_limiter.acquire(priority)
+        async with session.get(skin_url, headers=headers) as response:
+            if response.status == 429:
+                 print(f"Rate limited by Steam getting image for {skin_name}. Pausing Steam requests...")
+                 steam_rate_limiter.back_off(STEAM_RATE_LIMIT_BACKOFF)
+                 return None, False # Indicate rate limit
+            elif response.status != 200:
+                # Don't spam for 404s, but log other errors
+                if response.status != 404:
+                    print(f"Steam Market Error {response.status} getting image page for {skin_name}")
+                    return None, False
+                return None, True # No such listing
+
+            # Stream the page and scan each chunk for the large image, stopping as soon as it shows up
+            page = bytearray()
+            scan_from = 0
+            src = None
+            cpu_seconds = 0.0
+            async for chunk in response.content.iter_chunked(LISTING_STREAM_CHUNK_SIZE):
+                page += chunk
+                scan_started = time.thread_time()
+                src, scan_from = find_large_image_src(page, scan_from)
+                cpu_seconds += time.thread_time() - scan_started
+                if src:
+                    break
 
-        # Use BeautifulSoup to parse the HTML
-        soup = await asyncio.to_thread(BeautifulSoup, response.text, 'html.parser')
-
-        # Find the large image element
-        img_div = soup.find("div", class_="market_listing_largeimage")
-        if img_div:
-             img_tag = img_div.find("img", id="mainContentsContainer_item_image")
-             if img_tag and img_tag.get("src"):
-                src = img_tag["src"]
-                # Sometimes the src is relative, sometimes absolute
-                if src.startswith("https://steamcommunity-a.akamaihd.net/"):
-                    return src
-                elif not src.startswith("http"):
-                     # Fallback if structure changes, try constructing absolute URL
-                     # This might need adjustment if Steam changes CDN path
-                     return "https://steamcommunity-a.akamaihd.net/economy/image/" + src
-                else:
-                    return src # Already absolute URL
-
-        # Fallback: try finding the smaller image often used in listings
-        img_tag_small = soup.find("img", class_="market_listing_item_img")
-        if img_tag_small and img_tag_small.get("src"):
-            src = img_tag_small["src"]
-            if src.startswith("https://steamcommunity-a.akamaihd.net/"):
-                return src
-            elif not src.startswith("http"):
-                 return "https://steamcommunity-a.akamaihd.net/economy/image/" + src
-            else:
-                return src
+        early_exit = src is not None
+        if src is None:
+            # Not in the large image block; the whole-page scan for the fallback image runs in a worker process
+            src, worker_cpu_seconds = await asyncio.get_running_loop().run_in_executor(_get_listing_parse_pool(), extract_listing_image_src, bytes(page))
+            cpu_seconds += worker_cpu_seconds
+        _record_listing_parse(len(page), cpu_seconds, early_exit, not early_exit)
+        print(f"Image lookup for {skin_name}: {len(page)} bytes of listing HTML{' (stopped early)' if early_exit else ''}, {cpu_seconds * 1000:.1f}ms CPU")
+        if src:
+            return _absolute_image_url(src), True
 
         # print(f"Could not find image tag for {skin_name} on page {skin_url}")
-        return None
-    except requests.exceptions.Timeout:
+        return None, True
+    except asyncio.TimeoutError:
          print(f"Timeout getting Steam image for {skin_name}")
-         return None
-    except requests.exceptions.RequestException as e:
+         return None, False
+    except aiohttp.ClientError as e:
         print(f"Network error getting Steam image for {skin_name}: {e}")
-        return None
+        return None, False
     except Exception as e:
-        # Catch potential BeautifulSoup errors or others
+        # Catch extraction errors or others
         print(f"Error parsing image page or getting image for {skin_name}: {e}")
+        return None, False
+
+
+# --- Catalog Pre-warmer ---
+_prewarm_task: Optional[asyncio.Task] = None
+
+def catalog_warm_order(catalog: CaseCatalog) -> List[List[str]]:
+    """Groups every unboxable item of a catalog by base skin, most likely unbox first.
+
+    A skin's probability is its rarity's share of the case weights, split evenly across the
+    rarity's skins, summed over the cases it appears in (cases are treated as equally likely
+    to be opened). Within a skin, wears are ordered by condition_chances.
+    """
+    base_probability = {}
+    for case_data in catalog.cases.values():
+        weights = case_data.get("weights", {})
+        total_weight = sum(weights.values()) or 1.0
+        for rarity, skins in case_data.get("contents", {}).items():
+            if not skins:
+                continue
+            per_skin = weights.get(rarity, 0.0) / total_weight / len(skins)
+            for base_skin in skins:
+                base_probability[base_skin] = base_probability.get(base_skin, 0.0) + per_skin
+    # Within a skin, the most likely wear first (one bulk search covers all of them anyway)
+    suffixes = sorted(catalog.condition_chances, key=catalog.condition_chances.get, reverse=True)
+    return [[f"{base_skin}{suffix}" for suffix in suffixes]
+            for base_skin in sorted(base_probability, key=base_probability.get, reverse=True)]
+
+async def _prewarm_catalog_pass(session: aiohttp.ClientSession):
+    """Fetches every catalog price that is not fresh and every image not yet cached, at background priority."""
+    started = time.monotonic()
+    prices_warmed = images_warmed = 0
+    for item_names in catalog_warm_order(case_catalog): # A reload mid-pass is picked up by the next pass
+        stale = [item_name for item_name in item_names if not price_cache.is_fresh(item_name)]
+        if stale:
+            prices_warmed += len(await get_skin_prices_bulk(stale, session, PRIORITY_BACKGROUND))
+        for item_name in item_names:
+            if not image_url_cache.is_cached(item_name): # Bulk searches usually cached these already
+                if await get_skin_image_url(item_name, session, PRIORITY_BACKGROUND):
+                    images_warmed += 1
+    print(f"Catalog pre-warm pass done in {time.monotonic() - started:.0f}s: {prices_warmed} prices, {images_warmed} images fetched.")
+
+async def _catalog_prewarmer(session: aiohttp.ClientSession):
+    """Background task: keeps the whole case catalog's prices fresh and images cached."""
+    while True:
+        try:
+            await _prewarm_catalog_pass(session)
+        except Exception as e:
+            print(f"Error during catalog pre-warm pass: {e}")
+        await asyncio.sleep(PREWARM_INTERVAL)
+
+def start_catalog_prewarmer(session: aiohttp.ClientSession):
+    """Starts the pre-warmer on the running event loop (idempotent, no-op if disabled)."""
+    global _prewarm_task
+    if not PREWARM_ENABLED or (_prewarm_task is not None and not _prewarm_task.done()):
+        return
+    _prewarm_task = asyncio.get_running_loop().create_task(_catalog_prewarmer(session))
+
+def stop_catalog_prewarmer():
+    global _prewarm_task
+    if _prewarm_task is not None:
+        _prewarm_task.cancel()
+        _prewarm_task = None
+
+
+# --- Multi-open ---
+MULTI_OPEN_PATTERN = re.compile(r'^(?:(.*?)\s+)?x\s*(\d+)$', re.IGNORECASE) # "<case name> x 50", or "x 50" for a random case
+RARE_RARITY = "Rare Special Item (Gold)"
+rarity_colors = {
+    "Mil-Spec (Blue)": discord.Color.blue(), "Restricted (Purple)": discord.Color.purple(),
+    "Classified (Pink)": discord.Color.magenta(), "Covert (Red)": discord.Color.red(),
+    RARE_RARITY: discord.Color.gold()
+}
+
+def parse_multi_open(case_name_input: str):
+    """Splits '!case' input into (case name or None, count); count is 1 without an 'x N' suffix."""
+    match = MULTI_OPEN_PATTERN.match(case_name_input.strip())
+    if not match:
+        return case_name_input, 1
+    return (match.group(1) or None), int(match.group(2))
+
+def roll_case_batch(catalog: CaseCatalog, case_name: str, count: int) -> Optional[List[tuple]]:
+    """Rolls `count` items from a case as (rarity, skin) pairs, or None if the case is misconfigured."""
+    case_contents = catalog.cases[case_name].get("contents") or {}
+    rarities = catalog.rarity_samplers[case_name].sample(count)
+    wears = catalog.wear_sampler.sample(count)
+    if any(not case_contents.get(rarity) for rarity in set(rarities)) or not all(wears):
         return None
+    return [(rarity, f"{random.choice(case_contents[rarity])}{wear}") for rarity, wear in zip(rarities, wears)]
+
+async def open_case_batch(catalog: CaseCatalog, member: discord.Member, case_name: str, count: int, session: aiohttp.ClientSession, send):
+    """Opens `count` cases from `catalog` for a member and posts one summary embed via `send` (ctx.send or followup.send).
+
+    Prices are looked up once per distinct item and the user's stats change in one journal record,
+    so the cost follows the number of distinct items rather than `count`.
+    """
+    case_data = catalog.cases[case_name]
+    case_cost = case_data.get('cost', 0.0)
+    if not isinstance(case_cost, (int, float)) or case_cost <= 0:
+        await send(f"Error: The cost for '{case_name}' is not configured correctly.")
+        return
+    draws = roll_case_batch(catalog, case_name, count) if case_data.get("weights") else None
+    if draws is None:
+        await send(f"Error: Configuration error for '{case_name}'. Missing weights or contents.")
+        return
+
+    # --- !! BAN LOGIC !! --- (the batch stops at the first rare item if the ban goes through)
+    cases_opened = count
+    banned = False
+    rare_index = next((i for i, (rarity, _) in enumerate(draws) if rarity == RARE_RARITY), None)
+    if rare_index is not None and ENABLE_BAN_ON_KNIFE:
+        skin = draws[rare_index][1]
+        ban_embed = discord.Embed(title="🚨 RARE ITEM UNBOXED! 🚨", description=f"{member.mention} unboxed **{skin}** ({RARE_RARITY}) from {case_name} (case {rare_index + 1} of {count})! Initiating protocol...", color=discord.Color.gold())
+        ban_img_url = await get_skin_image_url(skin, session)
+        if ban_img_url: ban_embed.set_thumbnail(url=ban_img_url)
+        await send(embed=ban_embed)
+        await asyncio.sleep(2.5) # Dramatic pause
+        try:
+            await member.ban(reason=f"Unboxed a rare item ({skin}) from {case_name}!")
+            await send(f"*{member.display_name} has been banned for unboxing a rare item.* Good luck!")
+            print(f"Banned {member.name} ({member.id}) for unboxing {skin}.")
+            banned = True
+            cases_opened = rare_index + 1 # The remaining cases are never opened, the rare item is not kept
+            draws = draws[:rare_index]
+        except discord.Forbidden:
+            await send(f"⚠️ {member.mention} unboxed **{skin}**! I tried to ban them, but I lack the 'Ban Members' permission.")
+        except discord.HTTPException as e:
+            await send(f"⚠️ {member.mention} unboxed **{skin}**! Failed to ban due to an API error: {e}")
+        except Exception as e:
+            await send(f"⚠️ {member.mention} unboxed **{skin}**! An unexpected error occurred during the ban process: {e}")
+    # --- !! END BAN LOGIC !! ---
+
+    item_counts = Counter(skin for _, skin in draws)
+    prices = await get_skin_prices_bulk(item_counts.keys(), session, PRIORITY_INTERACTIVE)
+    unit_values = {skin: parse_price(prices.get(skin)) for skin in item_counts}
+    total_value = sum(unit_values[skin] * item_count for skin, item_count in item_counts.items())
+    total_cost = case_cost * cases_opened
+    record_case_batch(member.id, cases_opened, total_value - total_cost, dict(item_counts))
+    schedule_user_data_save() # Written by the background flusher
+
+    # --- Summary Embed ---
+    rarity_counts = Counter(rarity for rarity, _ in draws)
+    best_rarity = max((rarity for rarity in rarity_counts if rarity in rarity_colors), key=list(rarity_colors).index, default=None)
+    user_record = get_user_data_entry(member.id)
+    embed = discord.Embed(
+        title=f"📦 {member.display_name} opened {cases_opened}× {case_name}",
+        description=(
+            f"Cost: **£{total_cost:.2f}** | Items value: **£{total_value:.2f}** | Net: **£{total_value - total_cost:+.2f}**\n\n"
+            f"*{len(draws)} items added to inventory.*\n"
+            f"Your Total P/L: **£{user_record.profit_loss:.2f}** | Cases Opened: **{user_record.cases_opened}**"
+        ),
+        color=rarity_colors.get(best_rarity, discord.Color.default())
+    )
+    if rarity_counts:
+        embed.add_field(name="Rarities", value="\n".join(f"{rarity}: **{rarity_counts[rarity]}**" for rarity in sorted(rarity_counts, key=lambda r: -rarity_counts[r])), inline=False)
+        best_items = sorted(item_counts, key=lambda skin: unit_values[skin], reverse=True)[:10]
+        embed.add_field(
+            name="Best drops",
+            value="\n".join(f"{item_counts[skin]}× {skin} — {prices.get(skin) or 'Unknown'}" for skin in best_items)[:1024],
+            inline=False
+        )
+        best_img_url = await get_skin_image_url(best_items[0], session)
+        if best_img_url: embed.set_thumbnail(url=best_img_url)
+    unpriced = sum(1 for skin in item_counts if skin not in prices)
+    if unpriced:
+        embed.set_footer(text=f"No market price found for {unpriced} item types (counted as £0).")
+    if banned:
+        embed.set_footer(text=f"Stopped after case {cases_opened}: banned for unboxing a rare item.")
+    await send(embed=embed)
+
+
+# --- Expected Value Simulator ---
+_ev_results = OrderedDict() # (case name, opens) -> (signature, result), least recently used first
+
+def simulate_case_openings(probabilities: List[float], values: List[float], cost: float, opens: int) -> dict:
+    """Monte Carlo P/L of opening a case `opens` times (NumPy, run it off the event loop)."""
+    rng = np.random.default_rng()
+    cdf = np.cumsum(np.asarray(probabilities, dtype=np.float64))
+    cdf /= cdf[-1]
+    item_values = np.asarray(values, dtype=np.float64)
+    trials = max(EV_MIN_TRIALS, min(EV_MAX_TRIALS, EV_SIMULATION_DRAWS // opens))
+    totals = np.empty(trials)
+    rows_per_chunk = max(1, EV_CHUNK_DRAWS // opens)
+    for start in range(0, trials, rows_per_chunk):
+        rows = min(rows_per_chunk, trials - start)
+        drops = np.searchsorted(cdf, rng.random((rows, opens)), side='right') # Inverse CDF sampling
+        totals[start:start + rows] = item_values[drops].sum(axis=1)
+    profit_loss = totals - cost * opens
+    counts, edges = np.histogram(profit_loss, bins=8)
+    return {
+        "trials": trials,
+        "mean": float(profit_loss.mean()),
+        "p_profit": float((profit_loss > 0).mean()),
+        "percentiles": dict(zip((5, 25, 50, 75, 95), (float(x) for x in np.percentile(profit_loss, (5, 25, 50, 75, 95))))),
+        "histogram": list(zip(edges[:-1].tolist(), edges[1:].tolist(), counts.tolist())),
+    }
+
+async def case_expected_value(catalog: CaseCatalog, case_name: str, opens: int) -> dict:
+    """Expected value of a catalog's case from cached prices, plus a simulated P/L distribution for `opens` opens.
+
+    Results are reused until the catalog or any of the case's cached prices change.
+    """
+    drop_table = catalog.drop_tables[case_name]
+    prices = [price_cache.peek(item_name) for item_name, _ in drop_table]
+    values = [parse_price(price_str) if price_str else 0.0 for price_str in prices]
+    signature = (catalog.version, tuple(prices))
+    cached = _ev_results.get((case_name, opens))
+    if cached is not None and cached[0] == signature:
+        _ev_results.move_to_end((case_name, opens))
+        return cached[1]
+
+    cost = catalog.cases[case_name].get("cost", 0.0)
+    item_ev = sum(probability * value for (_, probability), value in zip(drop_table, values))
+    result = {
+        "cost": cost,
+        "item_ev": item_ev,
+        "priced_items": sum(1 for price_str in prices if price_str),
+        "total_items": len(drop_table),
+        "priced_probability": sum(probability for (_, probability), price_str in zip(drop_table, prices) if price_str),
+        "simulation": None,
+    }
+    if np is not None and drop_table:
+        result["simulation"] = await asyncio.to_thread(simulate_case_openings, [probability for _, probability in drop_table], values, cost, opens)
+
+    _ev_results[(case_name, opens)] = (signature, result)
+    while len(_ev_results) > EV_RESULT_CACHE_SIZE:
+        _ev_results.popitem(last=False)
+    return result
+
+def build_ev_embed(case_name: str, opens: int, result: dict) -> discord.Embed:
+    """Formats a case_expected_value() result."""
+    cost, item_ev = result["cost"], result["item_ev"]
+    embed = discord.Embed(
+        title=f"📈 Expected value: {case_name}",
+        description=(
+            f"Cost: **£{cost:.2f}** | Average item value: **£{item_ev:.2f}**\n"
+            f"Expected P/L per case: **£{item_ev - cost:+.2f}** (ROI {((item_ev - cost) / cost * 100) if cost else 0:+.1f}%)"
+        ),
+        color=discord.Color.teal()
+    )
+    simulation = result["simulation"]
+    if simulation is not None:
+        percentiles = simulation["percentiles"]
+        embed.add_field(
+            name=f"🎲 Opening {opens}× ({simulation['trials']:,} simulated runs)",
+            value=(
+                f"Expected P/L: **£{simulation['mean']:+.2f}** | Chance of profit: **{simulation['p_profit'] * 100:.1f}%**\n"
+                f"Median: £{percentiles[50]:+.2f} | Middle 50%: £{percentiles[25]:+.2f} to £{percentiles[75]:+.2f}\n"
+                f"5th-95th percentile: £{percentiles[5]:+.2f} to £{percentiles[95]:+.2f}"
+            ),
+            inline=False
+        )
+        largest = max(count for _, _, count in simulation["histogram"]) or 1
+        bars = "\n".join(
+            f"{low:>+9.2f} to {high:>+9.2f} {'█' * round(count / largest * 20):<20} {count / simulation['trials'] * 100:5.1f}%"
+            for low, high, count in simulation["histogram"]
+        )
+        embed.add_field(name="P/L distribution (£)", value=f"```\n{bars}\n```", inline=False)
+    else:
+        embed.add_field(name="🎲 Simulation", value="Install numpy to simulate P/L distributions.", inline=False)
+    embed.set_footer(text=(
+        f"Using cached market prices for {result['priced_items']}/{result['total_items']} possible drops "
+        f"({result['priced_probability'] * 100:.1f}% of outcomes); unpriced drops count as £0."
+    ))
+    return embed
+
+
+# --- Display Names ---
+class DisplayNameCache:
+    """Leaderboard display names per guild, resolved in batches and reused for `ttl` seconds.
+
+    Names come from the member/user cache first; whoever is missing is fetched with one
+    query_members call per 100 users. Users that cannot be found are remembered too, so a
+    departed member does not trigger a gateway query on every leaderboard.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._names = {} # (guild_id or None, user_id) -> (display name or None, resolved_at)
+
+    async def resolve(self, bot: commands.Bot, guild: Optional[discord.Guild], user_ids: List[int]) -> dict:
+        """Returns {user_id: display name} for every user that could be resolved."""
+        guild_id = guild.id if guild else None
+        now = time.monotonic()
+        names = {}
+        missing = []
+        for uid in user_ids:
+            entry = self._names.get((guild_id, uid))
+            if entry is not None and now - entry[1] < self.ttl:
+                if entry[0] is not None:
+                    names[uid] = entry[0]
+            else:
+                missing.append(uid)
+        if not missing:
+            return names
+
+        unresolved = []
+        for uid in missing:
+            user = (guild.get_member(uid) if guild else None) or bot.get_user(uid)
+            if user:
+                names[uid] = user.display_name
+            else:
+                unresolved.append(uid)
+        if guild is not None:
+            for i in range(0, len(unresolved), 100): # query_members takes at most 100 IDs
+                try:
+                    for member in await guild.query_members(user_ids=unresolved[i:i + 100], limit=100, cache=True):
+                        names[member.id] = member.display_name
+                except Exception as e:
+                    print(f"Error resolving leaderboard names in guild {guild.id}: {e}")
+        for uid in missing:
+            self._names[(guild_id, uid)] = (names.get(uid), now)
+        return names
+
+display_name_cache = DisplayNameCache(DISPLAY_NAME_TTL)
 
 
 # --- UI Views ---
 
 class InventoryView(discord.ui.View):
-    """Adds a recalculate button to the inventory message."""
-    def __init__(self, original_user_id: int, timeout=180): # Timeout after 3 minutes
+    """Inventory pages with previous/next/values buttons, plus a recalculate button.
+
+    The sorted item list is built once when the view is created; each page's embed is only
+    rendered when it is shown.
+    """
+    def __init__(self, original_user_id: int, session: aiohttp.ClientSession, owner_name: str, timeout=180): # Timeout after 3 minutes
         super().__init__(timeout=timeout)
         self.original_user_id = original_user_id
+        self.session = session # The bot's shared Steam session
+        self.owner_name = owner_name
+        # Sort items alphabetically for consistent display
+        self.items = sorted(get_user_data_entry(original_user_id).inventory_by_name().items())
+        self.page_count = max(1, -(-len(self.items) // INVENTORY_PAGE_SIZE))
+        self.page = 0
+        self.show_values = False
+
+        if self.page_count > 1:
+            self.previous_button = discord.ui.Button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+            self.previous_button.callback = self.previous_callback
+            self.add_item(self.previous_button)
+            self.next_button = discord.ui.Button(label="Next ▶", style=discord.ButtonStyle.secondary)
+            self.next_button.callback = self.next_callback
+            self.add_item(self.next_button)
+        if self.items:
+            self.values_button = discord.ui.Button(label="Show Values", style=discord.ButtonStyle.secondary)
+            self.values_button.callback = self.values_callback
+            self.add_item(self.values_button)
         self.recalculate_button = discord.ui.Button(label="Recalculate Current Value", style=discord.ButtonStyle.primary, custom_id="recalc_inv_value")
         self.recalculate_button.callback = self.recalculate_callback # Assign callback here
         self.add_item(self.recalculate_button)
         self.message = None # To store the message this view is attached to
+        self._update_buttons()
+
+    def render_page(self) -> discord.Embed:
+        """Builds the embed for the current page (stats are read fresh, items from the cached list)."""
+        user_record = get_user_data_entry(self.original_user_id)
+        embed = discord.Embed(title=f"{self.owner_name}'s Inventory & Stats", color=discord.Color.green())
+        embed.add_field(name="📊 Total Profit/Loss", value=f"**£{user_record.profit_loss:.2f}**", inline=True)
+        embed.add_field(name="📦 Cases Opened", value=f"**{user_record.cases_opened}**", inline=True)
+        priced, held = inventory_value_coverage(user_record)
+        value_text = f"**£{user_record.inventory_value:.2f}**"
+        if priced < held: # Unpriced items count as £0, say so instead of showing a bare total
+            value_text += f"\n{priced}/{held} item types priced"
+        embed.add_field(name="💷 Inventory Value", value=value_text, inline=True)
+
+        if not self.items:
+            embed.description = "\nInventory is empty. Use `!case <Case Name>` to open cases!"
+            return embed
+
+        start = self.page * INVENTORY_PAGE_SIZE
+        description_lines = ["\n**Items:**"]
+        for item_name, count in self.items[start:start + INVENTORY_PAGE_SIZE]:
+            line = f"**{count}x** {item_name}" # Bold count, regular item name
+            if self.show_values:
+                # Only what is already cached, so flipping pages never waits on Steam
+                price_str = price_cache.peek(item_name)
+                line += f" — {price_str} each" if price_str else " — price not cached"
+            description_lines.append(line)
+        embed.description = "\n".join(description_lines)
+        embed.set_footer(text=f"Page {self.page + 1}/{self.page_count} · {len(self.items)} item types")
+        return embed
+
+    def _update_buttons(self):
+        if self.page_count > 1:
+            self.previous_button.disabled = self.page == 0
+            self.next_button.disabled = self.page == self.page_count - 1
+        if self.items:
+            self.values_button.label = "Hide Values" if self.show_values else "Show Values"
+
+    async def _show_page(self, interaction: discord.Interaction):
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.render_page(), view=self) # Edit in place
+
+    async def previous_callback(self, interaction: discord.Interaction):
+        self.page = max(0, self.page - 1)
+        await self._show_page(interaction)
+
+    async def next_callback(self, interaction: discord.Interaction):
+        self.page = min(self.page_count - 1, self.page + 1)
+        await self._show_page(interaction)
+
+    async def values_callback(self, interaction: discord.Interaction):
+        self.show_values = not self.show_values
+        await self._show_page(interaction)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         # Only allow the original command user to interact
         if interaction.user.id != self.original_user_id:
-            await interaction.response.send_message("Sorry, only the person who requested the inventory can recalculate.", ephemeral=True)
+            await interaction.response.send_message("Sorry, only the person who requested the inventory can use these buttons.", ephemeral=True)
             return False
         return True
 
     async def on_timeout(self):
-        # Disable button on timeout
-        self.recalculate_button.disabled = True
+        # Disable buttons on timeout
+        for item in self.children:
+            item.disabled = True
         if self.message:
             try:
                 await self.message.edit(view=self)
@@ -407,105 +2549,104 @@ class InventoryView(discord.ui.View):
         await interaction.response.defer(thinking=True, ephemeral=False) # Show loading state
 
         user_id = interaction.user.id
-        user_entry = get_user_data_entry(user_id)
-        user_inv = user_entry.get("inventory", {})
+        user_record = get_user_data_entry(user_id)
 
-        if not user_inv:
+        if not user_record.inventory:
             await interaction.followup.send("Your inventory is empty, nothing to recalculate.", ephemeral=True)
             return
 
-        total_recalculated_value = 0.0
-        items_processed = 0
-        items_failed = 0
-        rate_limit_waits = 0
-        max_retries = 2 # Max retries per item on rate limit
-
-        # Use a single session for all requests in this batch
-        async with asyncio.timeout(120): # Timeout for the whole recalc process (e.g., 2 mins)
+        # The value is kept current as prices change, so only prices that are no longer fresh need fetching.
+        # Prices fetched by an earlier, timed-out recalculation are still fresh and are not fetched again.
+        stale_items = [item_names[item_id] for item_id in user_record.inventory if not price_cache.is_fresh(item_names[item_id])]
+        pending = set(stale_items)
+        timed_out = False
+        progress_message = None
+        if stale_items:
+            progress_message = await interaction.followup.send(embed=self.recalculation_embed(interaction.user, len(stale_items), pending), wait=True)
+            last_edit = time.monotonic()
             try:
-                async with aiohttp.ClientSession() as session: # Using aiohttp for better async handling
-                    tasks = []
-                    item_counts = {} # Store counts to multiply later
-
-                    for item_name, count in user_inv.items():
-                         tasks.append(self.fetch_item_price(item_name, session))
-                         item_counts[item_name] = count
-
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                    for item_name, result in zip(item_counts.keys(), results):
-                        if isinstance(result, Exception):
-                             print(f"Error fetching price during recalc for {item_name}: {result}")
-                             items_failed += 1
-                        elif result is None:
-                             items_failed += 1 # Price not found or API error
-                        else:
-                            item_value = parse_price(result) # result is price_str here
-                            total_recalculated_value += (item_value * item_counts[item_name])
-                            items_processed += 1
-
+                async with asyncio.timeout(RECALC_TIMEOUT):
+                    # Bulk market searches price many item types per request; new prices update the value via the price hook
+                    async for done_items, _ in iter_skin_prices_bulk(stale_items, self.session, PRIORITY_BULK): # Yields to interactive opens
+                        pending.difference_update(done_items)
+                        if pending and time.monotonic() - last_edit >= RECALC_PROGRESS_INTERVAL:
+                            await progress_message.edit(embed=self.recalculation_embed(interaction.user, len(stale_items), pending))
+                            last_edit = time.monotonic()
             except asyncio.TimeoutError:
-                 await interaction.followup.send("Recalculation timed out. Please try again later.", ephemeral=True)
-                 return
+                timed_out = True # Report what we have; unfinished lookups keep running and fill the cache
             except Exception as e:
                 print(f"Unexpected error during inventory recalculation: {e}")
                 await interaction.followup.send(f"An unexpected error occurred during recalculation: {e}", ephemeral=True)
                 return
 
+        if not timed_out:
+            # Disable button after successful calculation
+            self.recalculate_button.disabled = True
+            # Update the original message's view
+            try:
+                if self.message: await self.message.edit(view=self)
+            except discord.NotFound: pass # Ignore if original message deleted
+            except discord.HTTPException as e: print(f"Error disabling button after recalc: {e}")
 
-        # Disable button after successful calculation
-        self.recalculate_button.disabled = True
-        # Update the original message's view
-        try:
-            if self.message: await self.message.edit(view=self)
-        except discord.NotFound: pass # Ignore if original message deleted
-        except discord.HTTPException as e: print(f"Error disabling button after recalc: {e}")
-
-
-        result_embed = discord.Embed(
-            title=f"{interaction.user.display_name}'s Recalculated Inventory Value",
-            description=f"Estimated current market value of your inventory: **£{total_recalculated_value:.2f}**",
-            color=discord.Color.blue()
-        )
-        result_embed.set_footer(text=f"Processed {items_processed} item types. Failed to fetch price for {items_failed} types.")
-
-        await interaction.followup.send(embed=result_embed) # Send result as a followup
-
-    async def fetch_item_price(self, item_name: str, session):
-        """Helper to fetch price, potentially move outside if used elsewhere"""
-        # Simplified version for recalc - does not need full market data, just price str
-        # Note: This uses requests via to_thread, consider switching to aiohttp if performance is critical
-        # For simplicity, sticking with requests for now.
-        temp_req_session = requests.Session() # Create session within the async task
-        price_str = await get_skin_price_str(item_name, temp_req_session)
-        temp_req_session.close() # Close session
-        return price_str
+        result_embed = self.recalculation_embed(interaction.user, len(stale_items), pending, finished=True)
+        if progress_message is not None:
+            await progress_message.edit(embed=result_embed)
+        else:
+            await interaction.followup.send(embed=result_embed) # Send result as a followup
+
+    def recalculation_embed(self, user: discord.abc.User, refreshing: int, pending: set, finished: bool = False) -> discord.Embed:
+        """Progress / result embed for a recalculation; the value is the running, incrementally kept total."""
+        user_record = get_user_data_entry(self.original_user_id)
+        if not finished:
+            title = f"{user.display_name}'s Inventory Value (recalculating...)"
+            color = discord.Color.light_grey()
+        elif pending:
+            title = f"{user.display_name}'s Inventory Value (partial)"
+            color = discord.Color.orange()
+        else:
+            title = f"{user.display_name}'s Recalculated Inventory Value"
+            color = discord.Color.blue()
+        description = f"Estimated current market value of your inventory: **£{user_record.inventory_value:.2f}**"
+        if refreshing:
+            description += f"\nRefreshed prices: **{refreshing - len(pending)}/{refreshing}** item types"
+        embed = discord.Embed(title=title, description=description, color=color)
+
+        if finished and pending:
+            pending_names = sorted(pending)
+            pending_list = "\n".join(pending_names[:15])
+            if len(pending_names) > 15:
+                pending_list += f"\n... and {len(pending_names) - 15} more"
+            embed.add_field(name=f"⏳ Still pending ({len(pending_names)})", value=pending_list[:1024], inline=False)
+            embed.set_footer(text="Timed out; pending items count at their last known price (or £0). Prices fetched so far are kept, so Recalculate again only fetches the rest.")
+        elif finished:
+            items_priced = sum(1 for item_id in user_record.inventory if item_unit_values.get(item_id))
+            embed.set_footer(text=f"Priced {items_priced} item types ({refreshing} refreshed). No price found for {len(user_record.inventory) - items_priced} types.")
+        return embed
 
 
 # --- Cog for Case and General Commands ---
 class CaseCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        # Use a persistent session for Steam API calls to potentially reuse connections
-        self.http_session = requests.Session()
-        # Rate limiting simple state
-        self.last_api_call_time = 0
-        self.api_call_delay = 1.5 # Seconds between calls (adjust as needed)
+        # The bot owns the Steam session (pooled keep-alive connections shared by every cog)
+        self.http_session = bot.steam_session
+        # Steam requests are rate limited globally by steam_rate_limiter
+        self._leaderboard_embeds = {} # (guild_id, sort_by_cases, count) -> (rows, rendered_at, embed)
 
 
-    def cog_unload(self):
-        """Close the session when the cog is unloaded."""
-        self.http_session.close()
-        print("HTTP session closed for CaseCommands.")
+    async def cog_load(self):
+        """Start writing user data, watching the case catalog and warming the Steam caches in the background once the cog is live."""
+        start_user_data_flusher()
+        start_case_catalog_watcher()
+        start_catalog_prewarmer(self.http_session)
 
 
-    async def check_api_rate_limit(self):
-         """Simple delay-based rate limiting for Steam API calls."""
-         now = asyncio.get_event_loop().time()
-         time_since_last_call = now - self.last_api_call_time
-         if time_since_last_call < self.api_call_delay:
-             await asyncio.sleep(self.api_call_delay - time_since_last_call)
-         self.last_api_call_time = asyncio.get_event_loop().time()
+    def cog_unload(self):
+        """Flush pending user data when the cog is unloaded."""
+        stop_catalog_prewarmer()
+        stop_case_catalog_watcher()
+        stop_user_data_flusher()
+        print("User data flushed.")
 
 
     @commands.command(name="cases")
@@ -513,7 +2654,7 @@ class CaseCommands(commands.Cog):
         """Lists the available cases and their opening costs."""
         embed = discord.Embed(title="Available Cases", color=discord.Color.orange())
         description = ""
-        for name, data in all_cases.items():
+        for name, data in case_catalog.cases.items():
             cost = data.get('cost', 'N/A')
             cost_str = f"£{cost:.2f}" if isinstance(cost, (int, float)) else str(cost)
             description += f"🔹 **{name}** - Cost: {cost_str}\n"
@@ -524,45 +2665,68 @@ class CaseCommands(commands.Cog):
         embed.description = description
         await ctx.send(embed=embed)
 
+    @commands.command(name="reloadcases")
+    async def reload_cases(self, ctx):
+        """Bot owner only: reloads the case catalog file now (it is also reloaded automatically when it changes)."""
+        if not await self.bot.is_owner(ctx.author):
+            await ctx.send("Only the bot owner can reload the case catalog.")
+            return
+        errors = reload_case_catalog()
+        if errors:
+            problems = "\n".join(f"• {error}" for error in errors[:10])
+            more = f"\n…and {len(errors) - 10} more." if len(errors) > 10 else ""
+            await ctx.send(f"⚠️ `{CASE_CATALOG_FILE}` was not loaded, still using version {case_catalog.version}:\n{problems}{more}"[:2000])
+            return
+        await ctx.send(f"✅ Case catalog version {case_catalog.version} loaded: {len(case_catalog.cases)} cases.")
+
+    async def resolve_case_name(self, ctx, catalog: CaseCatalog, case_name_input: str) -> Optional[str]:
+        """Looks a typed case name up in the catalog's name index, telling the user about guesses and ambiguity."""
+        case_name, match_kind, suggestions = catalog.name_index.resolve(case_name_input)
+        if case_name is not None:
+            if match_kind != "exact":
+                await ctx.send(f"Assuming you meant: **{case_name}**")
+            return case_name
+        if suggestions:
+            await ctx.send(f"Found multiple possible matches for '{case_name_input}'. Please be more specific: `{'`, `'.join(suggestions)}`")
+        else:
+            await ctx.send(f"Sorry, I couldn't find the case '{case_name_input}'. Use `!cases` to see available ones.")
+        return None
+
     @commands.command(name="case")
     async def case_command(self, ctx, *, case_name_input: Optional[str] = None):
-        """Opens a CS:GO case. Specify name or leave blank for random."""
+        """Opens a CS:GO case. Specify name or leave blank for random; add 'x N' to open N at once."""
         user_id = ctx.author.id
         member = ctx.author # Get member object for potential ban
+        catalog = case_catalog # This open finishes against this catalog even if the file is reloaded meanwhile
 
         chosen_case_data = None
         chosen_case_name = None
 
+        open_count = 1
+        if case_name_input:
+            case_name_input, open_count = parse_multi_open(case_name_input)
+            if not 1 <= open_count <= MAX_MULTI_OPEN:
+                await ctx.send(f"You can open between 1 and {MAX_MULTI_OPEN} cases at once.")
+                return
+
         if not case_name_input:
             # Randomly select a case if none provided
-            if not all_cases:
+            if not catalog.cases:
                  await ctx.send("No cases are configured!")
                  return
-            chosen_case_name = random.choice(list(all_cases.keys()))
-            chosen_case_data = all_cases[chosen_case_name]
+            chosen_case_name = random.choice(list(catalog.cases.keys()))
+            chosen_case_data = catalog.cases[chosen_case_name]
             await ctx.send(f"Randomly selected: **{chosen_case_name}**")
         else:
-            # Find the chosen case (case-insensitive matching)
-            found = False
-            for name, data in all_cases.items():
-                if case_name_input.lower() == name.lower():
-                    chosen_case_data = data
-                    chosen_case_name = name
-                    found = True
-                    break
-            if not found:
-                # Simple fuzzy matching: check if input is substring of any case name
-                possible_matches = [name for name in all_cases if case_name_input.lower() in name.lower()]
-                if len(possible_matches) == 1:
-                     chosen_case_name = possible_matches[0]
-                     chosen_case_data = all_cases[chosen_case_name]
-                     await ctx.send(f"Assuming you meant: **{chosen_case_name}**")
-                elif len(possible_matches) > 1:
-                     await ctx.send(f"Found multiple possible matches for '{case_name_input}'. Please be more specific: `{'`, `'.join(possible_matches)}`")
-                     return
-                else:
-                    await ctx.send(f"Sorry, I couldn't find the case '{case_name_input}'. Use `!cases` to see available ones.")
-                    return
+            # Find the chosen case (exact, prefix, substring or misspelled name)
+            chosen_case_name = await self.resolve_case_name(ctx, catalog, case_name_input)
+            if chosen_case_name is None:
+                return
+            chosen_case_data = catalog.cases[chosen_case_name]
+
+        if open_count > 1:
+            await open_case_batch(catalog, member, chosen_case_name, open_count, self.http_session, ctx.send)
+            return
 
         # --- Get Case Cost ---
         case_cost = chosen_case_data.get('cost', 0.0)
@@ -573,7 +2737,7 @@ class CaseCommands(commands.Cog):
         # --- Increment cases opened and Deduct cost ---
         increment_cases_opened(user_id)
         update_user_score(user_id, -case_cost)
-        save_user_data() # Save after score/count updates
+        schedule_user_data_save() # Written by the background flusher
         # ---
 
         embed = discord.Embed(title=f"📦 Opening {chosen_case_name}...",
@@ -593,7 +2757,7 @@ class CaseCommands(commands.Cog):
             return
 
         # 1. Determine Rarity
-        rarity = weighted_random_choice(case_weights)
+        rarity = catalog.rarity_samplers[chosen_case_name].choice()
         if not rarity or rarity not in case_contents or not case_contents[rarity]:
             await message.edit(embed=discord.Embed(title="Error", description=f"Configuration error for '{chosen_case_name}'. Could not determine item pool for rarity '{rarity}'.", color=discord.Color.red()))
             return
@@ -602,7 +2766,7 @@ class CaseCommands(commands.Cog):
         base_skin = random.choice(case_contents[rarity])
 
         # 3. Determine Condition (Wear)
-        condition_suffix = weighted_random_choice(condition_chances)
+        condition_suffix = catalog.wear_sampler.choice()
         if not condition_suffix:
             print("Warning: Could not determine condition, defaulting to Field-Tested.")
             condition_suffix = " (Field-Tested)" # Fallback
@@ -612,11 +2776,10 @@ class CaseCommands(commands.Cog):
         # ---
 
         # --- !! BAN LOGIC !! ---
-        if rarity == "Rare Special Item (Gold)" and ENABLE_BAN_ON_KNIFE:
+        if rarity == RARE_RARITY and ENABLE_BAN_ON_KNIFE:
             try:
                 ban_embed = discord.Embed(title="🚨 RARE ITEM UNBOXED! 🚨", description=f"{member.mention} unboxed **{skin}** ({rarity}) from {chosen_case_name}! Initiating protocol...", color=discord.Color.gold())
                 # Fetch image for the ban message if possible
-                await self.check_api_rate_limit()
                 ban_img_url = await get_skin_image_url(skin, self.http_session)
                 if ban_img_url: ban_embed.set_thumbnail(url=ban_img_url)
 
@@ -642,9 +2805,7 @@ class CaseCommands(commands.Cog):
         # ---
 
         # --- Get Price and Image ---
-        await self.check_api_rate_limit()
         price_str_task = asyncio.create_task(get_skin_price_str(skin, self.http_session))
-        await self.check_api_rate_limit() # Separate small delay before image fetch too
         img_url_task = asyncio.create_task(get_skin_image_url(skin, self.http_session))
 
         price_str = await price_str_task
@@ -656,16 +2817,12 @@ class CaseCommands(commands.Cog):
         if item_value > 0:
             update_user_score(user_id, item_value)
         # ---
-        save_user_data() # Save data after item add and potential score update
+        schedule_user_data_save() # Written by the background flusher
 
         # --- Prepare Result Embed ---
-        color_map = {
-            "Mil-Spec (Blue)": discord.Color.blue(), "Restricted (Purple)": discord.Color.purple(),
-            "Classified (Pink)": discord.Color.magenta(), "Covert (Red)": discord.Color.red(),
-            "Rare Special Item (Gold)": discord.Color.gold()
-        }
-        current_profit_loss = user_data.get(user_id, {}).get("profit_loss", 0.0)
-        cases_opened_total = user_data.get(user_id, {}).get("cases_opened", 0)
+        user_record = get_user_data_entry(user_id)
+        current_profit_loss = user_record.profit_loss
+        cases_opened_total = user_record.cases_opened
 
         result_description = (
             f"From: **{chosen_case_name}**\n"
@@ -676,7 +2833,7 @@ class CaseCommands(commands.Cog):
         )
         embed = discord.Embed(title=f"You unboxed: {skin}",
                               description=result_description,
-                              color=color_map.get(rarity, discord.Color.default()))
+                              color=rarity_colors.get(rarity, discord.Color.default()))
 
         if img_url:
             embed.set_image(url=img_url)
@@ -689,48 +2846,15 @@ class CaseCommands(commands.Cog):
     @commands.command(aliases=['inv', 'score'])
     async def inventory(self, ctx):
         """Displays your item inventory, score, and cases opened."""
-        user_id = ctx.author.id
-        user_entry = get_user_data_entry(user_id) # Ensures entry exists
-        user_inv = user_entry.get("inventory", {})
-        profit_loss = user_entry.get("profit_loss", 0.0)
-        cases_opened = user_entry.get("cases_opened", 0) # Get cases opened
-
-        embed = discord.Embed(title=f"{ctx.author.display_name}'s Inventory & Stats", color=discord.Color.green())
-
-        embed.add_field(name="📊 Total Profit/Loss", value=f"**£{profit_loss:.2f}**", inline=True)
-        embed.add_field(name="📦 Cases Opened", value=f"**{cases_opened}**", inline=True)
-
-        if not user_inv:
-            embed.description = "\nInventory is empty. Use `!case <Case Name>` to open cases!"
-        else:
-            description_lines = ["\n**Items:**"]
-            # Sort items alphabetically for consistent display
-            sorted_items = sorted(user_inv.items())
-            for item_name, count in sorted_items:
-                 # Bold count, regular item name
-                description_lines.append(f"**{count}x** {item_name}")
-
-            full_description = "\n".join(description_lines)
-            # Handle potential description length limit (4096 chars)
-            if len(full_description) > 4000: # Leave some buffer
-                full_description = full_description[:4000] + "\n... (Inventory too large to display all)"
-            embed.description = full_description
-            # embed.set_footer(text="Item images and current values not shown here.") # Footer updated below
-
-        # Add the recalculate button view
-        view = InventoryView(original_user_id=ctx.author.id)
-        message = await ctx.send(embed=embed, view=view)
+        # The view holds the sorted item list and renders one page at a time
+        view = InventoryView(original_user_id=ctx.author.id, session=self.http_session, owner_name=ctx.author.display_name)
+        message = await ctx.send(embed=view.render_page(), view=view)
         view.message = message # Store the message reference in the view
 
 
     @commands.command(aliases=['lb', 'top'])
     async def leaderboard(self, ctx, sort_by: str = 'profit', count: int = 10):
         """Shows the leaderboard. Sort by 'profit' (default) or 'cases'."""
-        global user_data
-        if not user_data:
-             await ctx.send("No user data available to generate a leaderboard.")
-             return
-
         if count > 25 or count < 1:
             await ctx.send("Please specify a count between 1 and 25.")
             return
@@ -741,39 +2865,28 @@ class CaseCommands(commands.Cog):
              await ctx.send(f"Invalid sort option. Use 'profit' or 'cases'.")
              return
 
-        # Create a list of tuples: (user_id, profit, cases_opened)
-        leaderboard_data = []
-        for uid, data in user_data.items():
-            # Ensure data is valid and user has participated
-            if isinstance(data, dict) and ("profit_loss" in data or "cases_opened" in data):
-                 # Only include users who have opened at least one case or have non-zero profit
-                 if data.get("cases_opened", 0) > 0 or data.get("profit_loss", 0.0) != 0.0:
-                     leaderboard_data.append((
-                         uid,
-                         data.get("profit_loss", 0.0),
-                         data.get("cases_opened", 0)
-                     ))
-
-        if not leaderboard_data:
+        sort_by_cases = sort_by not in ['profit', 'pl', 'score']
+        sort_key_name = "Cases Opened" if sort_by_cases else "Profit/Loss"
+        sorted_data = get_leaderboard(sort_by_cases, count)
+
+        if not sorted_data:
             await ctx.send("Not enough data yet for a leaderboard (no one has opened cases or made profit/loss).")
             return
 
-        # Sort the data
-        if sort_by in ['profit', 'pl', 'score']:
-            sorted_data = sorted(leaderboard_data, key=lambda x: x[1], reverse=True)
-            sort_key_name = "Profit/Loss"
-        else: # sort by cases
-            sorted_data = sorted(leaderboard_data, key=lambda x: x[2], reverse=True)
-            sort_key_name = "Cases Opened"
-
+        # Reuse the last rendered board while its rows are unchanged
+        cache_key = (ctx.guild.id if ctx.guild else None, sort_by_cases, count)
+        cached = self._leaderboard_embeds.get(cache_key)
+        if cached is not None and cached[0] == sorted_data and time.monotonic() - cached[1] < DISPLAY_NAME_TTL:
+            await ctx.send(embed=cached[2])
+            return
 
         embed = discord.Embed(title=f"🏆 Leaderboard - Top {min(count, len(sorted_data))} by {sort_key_name}", color=discord.Color.gold())
+        user_names = await display_name_cache.resolve(self.bot, ctx.guild, [uid for uid, _, _ in sorted_data])
 
         lines = []
         rank = 1
         for uid, profit, cases in sorted_data[:count]:
-            user = self.bot.get_user(uid) # Try to get user object
-            user_name = user.display_name if user else f"User ID {uid}" # Fallback if user not found
+            user_name = user_names.get(uid, f"User ID {uid}") # Fallback if user not found
 
             # Format line: Rank. User: P/L | Cases
             lines.append(f"{rank}. **{user_name}**: £{profit:,.2f} | {cases} cases")
@@ -784,79 +2897,113 @@ class CaseCommands(commands.Cog):
         else:
              embed.description = "\n".join(lines)
 
+        self._leaderboard_embeds[cache_key] = (sorted_data, time.monotonic(), embed)
+        await ctx.send(embed=embed)
+
+
+    @commands.command(name="ev")
+    async def expected_value(self, ctx, *, case_name_input: Optional[str] = None):
+        """Shows a case's expected value and simulated P/L. Add 'x N' to simulate opening it N times."""
+        case_name, opens = parse_multi_open(case_name_input) if case_name_input else (None, 1)
+        if not case_name:
+            await ctx.send(f"Usage: `!ev <Case Name>` or `!ev <Case Name> x <1-{EV_MAX_OPENS}>`")
+            return
+        if not 1 <= opens <= EV_MAX_OPENS:
+            await ctx.send(f"You can simulate between 1 and {EV_MAX_OPENS} opens.")
+            return
+        catalog = case_catalog
+        case_name = await self.resolve_case_name(ctx, catalog, case_name)
+        if case_name is None:
+            return
+
+        async with ctx.typing():
+            result = await case_expected_value(catalog, case_name, opens)
+        await ctx.send(embed=build_ev_embed(case_name, opens, result))
+
+    @commands.command(name="steamstats")
+    async def steam_stats(self, ctx):
+        """Shows Steam request queue depth, wait times and cache hit rates."""
+        embed = discord.Embed(title="Steam Request Stats", color=discord.Color.dark_grey())
+        for priority_name, stats in steam_rate_limiter.stats().items():
+            embed.add_field(
+                name=f"⏱️ {priority_name.capitalize()}",
+                value=(f"Queued: **{stats['queued']}** | Sent: **{stats['granted']}**\n"
+                       f"Avg wait: {stats['avg_wait']:.2f}s | Max wait: {stats['max_wait']:.2f}s"),
+                inline=False
+            )
+        collapsed = steam_single_flight.collapsed
+        embed.add_field(
+            name="🔗 Coalesced requests",
+            value=(f"Started: {steam_single_flight.started} | In flight: {steam_single_flight.in_flight()}\n"
+                   f"Collapsed: {collapsed.get('price', 0)} price, {collapsed.get('image', 0)} image, {collapsed.get('search', 0)} search"),
+            inline=False
+        )
+        embed.add_field(
+            name="💰 Price cache",
+            value=f"Fresh hits: {price_cache.hits} | Stale hits: {price_cache.stale_hits} | Misses: {price_cache.misses}",
+            inline=False
+        )
+        embed.add_field(
+            name="🖼️ Image cache",
+            value=f"Hits: {image_url_cache.hits} | Misses: {image_url_cache.misses}",
+            inline=False
+        )
+        parse_stats = listing_parse_stats
+        pages = parse_stats["pages"]
+        embed.add_field(
+            name="📄 Listing page scans",
+            value=(f"Pages: {pages} (stopped early: {parse_stats['early_exits']}, worker scans: {parse_stats['pool_scans']}) | "
+                   f"Avg size: {parse_stats['bytes'] / pages / 1024 if pages else 0:.0f} KB\n"
+                   f"CPU per page: avg {parse_stats['cpu_seconds'] / pages * 1000 if pages else 0:.1f}ms, max {parse_stats['max_cpu_seconds'] * 1000:.1f}ms"),
+            inline=False
+        )
         await ctx.send(embed=embed)
 
 
 # --- Cog for Slash Commands ---
 
-# Generate choices dynamically, respecting Discord's limit of 25
-case_choices = [
-    app_commands.Choice(name=name, value=name)
-    for name in list(all_cases.keys())[:25] # Take only the first 25
-]
-if len(all_cases) > 25:
-    print("Warning: More than 25 cases defined, only the first 25 are available as slash command choices.")
+async def case_name_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    """Suggests cases from the whole catalog as the user types (reads the live catalog, so a reload needs no re-sync)."""
+    return [app_commands.Choice(name=name[:100], value=name[:100]) for name in case_catalog.name_index.complete(current, 25)]
 
 class CaseSlashCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        # Share the session from the other cog if possible, or create a new one
-        # For simplicity, we'll use the one from the main cog if available
-        # This assumes CaseCommands cog is loaded first or accessible
-        main_cog = bot.get_cog('CaseCommands')
-        if main_cog and hasattr(main_cog, 'http_session'):
-            self.http_session = main_cog.http_session
-            print("CaseSlashCommands using shared HTTP session.")
-        else:
-            print("CaseSlashCommands creating its own HTTP session.")
-            self.http_session = requests.Session()
-        # Share rate limiter too
-        self.last_api_call_time = 0
-        self.api_call_delay = 1.5
-        if main_cog and hasattr(main_cog, 'last_api_call_time'):
-            # This is tricky, direct sharing might cause race conditions if not careful
-            # Best might be to just have independent rate limiting per cog or a shared lock mechanism
-            # For now, independent rate limiting state:
-            self.last_api_call_time = 0
-            self.api_call_delay = 1.5
-            print("CaseSlashCommands using independent rate limiting state.")
-
-
-    def cog_unload(self):
-        """Close the session if this cog created it."""
-        main_cog = self.bot.get_cog('CaseCommands')
-        # Only close if the session doesn't belong to the main cog
-        if not (main_cog and hasattr(main_cog, 'http_session') and self.http_session == main_cog.http_session):
-             self.http_session.close()
-             print("HTTP session closed for CaseSlashCommands.")
-
-    async def check_api_rate_limit(self):
-         """Simple delay-based rate limiting for Steam API calls (independent)."""
-         now = asyncio.get_event_loop().time()
-         time_since_last_call = now - self.last_api_call_time
-         if time_since_last_call < self.api_call_delay:
-             await asyncio.sleep(self.api_call_delay - time_since_last_call)
-         self.last_api_call_time = asyncio.get_event_loop().time()
+        # Same shared Steam session as CaseCommands, owned (and closed) by the bot
+        self.http_session = bot.steam_session
+        # Steam requests are rate limited globally by steam_rate_limiter
+
+    async def resolve_case_name(self, interaction: discord.Interaction, catalog: CaseCatalog, case_name_input: str) -> Optional[str]:
+        """Looks a case name up in the catalog's name index; replies (ephemerally) and returns None if it can't."""
+        case_name, _, suggestions = catalog.name_index.resolve(case_name_input)
+        if case_name is None:
+            if suggestions:
+                await interaction.response.send_message(f"Found multiple possible matches for '{case_name_input}': `{'`, `'.join(suggestions)}`", ephemeral=True)
+            else:
+                await interaction.response.send_message(f"Sorry, I couldn't find the case '{case_name_input}'.", ephemeral=True)
+        return case_name
 
 
     @app_commands.command(name="case", description="Open a specified CS:GO case (£ cost varies), updates score & inventory.")
-    @app_commands.describe(case_name="The name of the case you want to open")
-    @app_commands.choices(case_name=case_choices) # Use the generated choices
-    async def slash_case(self, interaction: discord.Interaction, case_name: str):
+    @app_commands.describe(case_name="The name of the case you want to open", count=f"How many to open at once (1-{MAX_MULTI_OPEN})")
+    @app_commands.autocomplete(case_name=case_name_autocomplete)
+    async def slash_case(self, interaction: discord.Interaction, case_name: str, count: app_commands.Range[int, 1, MAX_MULTI_OPEN] = 1):
         """Slash command to open a CS:GO case."""
         user_id = interaction.user.id
         member = interaction.user # Get member object
+        catalog = case_catalog # This open finishes against this catalog even if the file is reloaded meanwhile
+
+        # Find the chosen case (autocomplete sends exact names, but typed text is accepted too)
+        chosen_case_name = await self.resolve_case_name(interaction, catalog, case_name)
+        if chosen_case_name is None:
+            return
+        chosen_case_data = catalog.cases[chosen_case_name]
 
         # Defer response early
         await interaction.response.defer(thinking=True, ephemeral=False) # Ephemeral=False makes it visible
 
-        # Find the chosen case (exact match from choices)
-        chosen_case_data = all_cases.get(case_name)
-        chosen_case_name = case_name # Name is guaranteed by choices
-
-        if not chosen_case_data:
-            # This should technically not happen if choices are used correctly
-            await interaction.followup.send(f"Error: Case data not found for '{case_name}'. This shouldn't happen.", ephemeral=True)
+        if count > 1:
+            await open_case_batch(catalog, member, chosen_case_name, count, self.http_session, interaction.followup.send)
             return
 
         # --- Get Case Cost ---
@@ -868,7 +3015,7 @@ class CaseSlashCommands(commands.Cog):
         # --- Increment cases opened and Deduct cost ---
         increment_cases_opened(user_id)
         update_user_score(user_id, -case_cost)
-        save_user_data() # Save after score/count updates
+        schedule_user_data_save() # Written by the background flusher
         # ---
 
         # --- Determine Rarity, Base Skin, and Condition ---
@@ -878,22 +3025,21 @@ class CaseSlashCommands(commands.Cog):
             await interaction.followup.send(f"Error: Configuration error for '{chosen_case_name}'. Missing weights or contents.")
             return
 
-        rarity = weighted_random_choice(case_weights)
+        rarity = catalog.rarity_samplers[chosen_case_name].choice()
         if not rarity or rarity not in case_contents or not case_contents[rarity]:
             await interaction.followup.send(f"Error: Configuration error for '{chosen_case_name}'. Could not determine item pool for rarity '{rarity}'.")
             return
 
         base_skin = random.choice(case_contents[rarity])
-        condition_suffix = weighted_random_choice(condition_chances)
+        condition_suffix = catalog.wear_sampler.choice()
         if not condition_suffix: condition_suffix = " (Field-Tested)" # Fallback
         skin = f"{base_skin}{condition_suffix}"
         # ---
 
         # --- !! BAN LOGIC !! ---
-        if rarity == "Rare Special Item (Gold)" and ENABLE_BAN_ON_KNIFE:
+        if rarity == RARE_RARITY and ENABLE_BAN_ON_KNIFE:
             initial_embed = discord.Embed(title="🚨 RARE ITEM UNBOXED! 🚨", description=f"{member.mention} unboxed **{skin}** ({rarity}) from {chosen_case_name}! Initiating protocol...", color=discord.Color.gold())
             # Try to add thumbnail to initial message too
-            await self.check_api_rate_limit()
             ban_img_url = await get_skin_image_url(skin, self.http_session)
             if ban_img_url: initial_embed.set_thumbnail(url=ban_img_url)
 
@@ -921,9 +3067,7 @@ class CaseSlashCommands(commands.Cog):
         # ---
 
         # --- Get Price and Image ---
-        await self.check_api_rate_limit()
         price_str_task = asyncio.create_task(get_skin_price_str(skin, self.http_session))
-        await self.check_api_rate_limit()
         img_url_task = asyncio.create_task(get_skin_image_url(skin, self.http_session))
 
         price_str = await price_str_task
@@ -934,17 +3078,13 @@ class CaseSlashCommands(commands.Cog):
         item_value = parse_price(price_str) if price_str else 0.0
         if item_value > 0:
             update_user_score(user_id, item_value)
-        save_user_data() # Save final state
+        schedule_user_data_save() # Written by the background flusher
         # ---
 
         # --- Prepare Result Embed ---
-        color_map = {
-            "Mil-Spec (Blue)": discord.Color.blue(), "Restricted (Purple)": discord.Color.purple(),
-            "Classified (Pink)": discord.Color.magenta(), "Covert (Red)": discord.Color.red(),
-            "Rare Special Item (Gold)": discord.Color.gold()
-        }
-        current_profit_loss = user_data.get(user_id, {}).get("profit_loss", 0.0)
-        cases_opened_total = user_data.get(user_id, {}).get("cases_opened", 0)
+        user_record = get_user_data_entry(user_id)
+        current_profit_loss = user_record.profit_loss
+        cases_opened_total = user_record.cases_opened
 
         result_description = (
             f"Opened: **{chosen_case_name}** (Cost: £{case_cost:.2f})\n"
@@ -954,7 +3094,7 @@ class CaseSlashCommands(commands.Cog):
         )
         embed = discord.Embed(title=f"You unboxed: {skin}",
                               description=result_description,
-                              color=color_map.get(rarity, discord.Color.default()))
+                              color=rarity_colors.get(rarity, discord.Color.default()))
 
         if img_url:
             embed.set_image(url=img_url)
@@ -964,6 +3104,19 @@ class CaseSlashCommands(commands.Cog):
         # Edit the original deferred response (followup message)
         await interaction.edit_original_response(embed=embed, view=None) # view=None ensures no lingering components
 
+    @app_commands.command(name="ev", description="Expected value and simulated profit/loss of opening a case.")
+    @app_commands.describe(case_name="The case to evaluate", opens=f"How many opens to simulate (1-{EV_MAX_OPENS})")
+    @app_commands.autocomplete(case_name=case_name_autocomplete)
+    async def slash_ev(self, interaction: discord.Interaction, case_name: str, opens: app_commands.Range[int, 1, EV_MAX_OPENS] = 1):
+        """Slash command version of !ev."""
+        catalog = case_catalog
+        case_name = await self.resolve_case_name(interaction, catalog, case_name)
+        if case_name is None:
+            return
+        await interaction.response.defer(thinking=True)
+        result = await case_expected_value(catalog, case_name, opens)
+        await interaction.followup.send(embed=build_ev_embed(case_name, opens, result))
+
 
 # --- Bot Events and Setup ---
 @bot.event
@@ -971,7 +3124,8 @@ async def on_ready():
     print(f'Logged in as {bot.user.name} ({bot.user.id})')
     print(f'Discord.py version: {discord.__version__}')
     print('------')
-    load_user_data() # Load data on ready
+    # User data is loaded once at startup; reloading here on every reconnect would throw away
+    # changes the flusher has not written yet
     await setup_cogs() # Setup cogs after ready seems safer
 
 async def setup_cogs():
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Byte-level extraction of skin image URLs from Steam market listing pages.
+
+Kept out of discordbot.py so the listing parse pool's worker processes only need this small
+module: importing it has no side effects (no data files, no network, no threads).
+"""
+import html
+import re
+import time
+from typing import Optional
+
+# Targeted byte-level scans for the two image selectors the listing page is read for; no DOM is built.
+_LARGE_IMAGE_DIV = re.compile(rb'<div\b[^>]*\bclass\s*=\s*["\'][^"\']*\bmarket_listing_largeimage\b[^>]*>', re.IGNORECASE)
+_DIV_END = re.compile(rb'</div\s*>', re.IGNORECASE)
+_IMG_TAG = re.compile(rb'<img\b[^>]*>', re.IGNORECASE)
+_TAG_ATTR = re.compile(rb'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+
+
+def _tag_attrs(tag: bytes) -> dict:
+    return {m.group(1).lower(): (m.group(2) or m.group(3) or m.group(4) or b"") for m in _TAG_ATTR.finditer(tag)}
+
+def find_large_image_src(page, start: int = 0):
+    """Looks for div.market_listing_largeimage > img#mainContentsContainer_item_image.
+
+    Returns (src or None, position to resume from once more of the page has arrived).
+    """
+    for div in _LARGE_IMAGE_DIV.finditer(page, start):
+        div_end = _DIV_END.search(page, div.end())
+        if div_end is None:
+            return None, div.start() # The div is not complete yet
+        for img in _IMG_TAG.finditer(page, div.end(), div_end.start()):
+            attrs = _tag_attrs(img.group())
+            if attrs.get(b"id") == b"mainContentsContainer_item_image" and attrs.get(b"src"):
+                return html.unescape(attrs[b"src"].decode("utf-8", "replace")), div.start()
+    return None, max(start, len(page) - 1024) # Keep some overlap, a tag may straddle two chunks
+
+def find_small_image_src(page) -> Optional[str]:
+    """Looks for the first img.market_listing_item_img."""
+    for img in _IMG_TAG.finditer(page):
+        attrs = _tag_attrs(img.group())
+        if b"market_listing_item_img" in attrs.get(b"class", b"").split() and attrs.get(b"src"):
+            return html.unescape(attrs[b"src"].decode("utf-8", "replace"))
+    return None
+
+def extract_listing_image_src(page: bytes):
+    """Full-page scan for either image (runs in a worker process). Returns (src or None, CPU seconds)."""
+    started = time.process_time()
+    src = find_large_image_src(page)[0] or find_small_image_src(page)
+    return src, time.process_time() - started